@@ -77,6 +77,8 @@ Icon made by Freepik from www.flaticon.com
 # => Well, then we also need to add the new keyword to the list through the internal listbox, which is too much dependence on the internal object IMO.
 
 import sys
+import time
+STARTED = time.perf_counter() # See --startup-time
 
 import tkinter as tk
 from tkinter import filedialog
@@ -86,8 +88,6 @@ from tkinter import messagebox
 from tkinter import font
 #from tkinter.font import families
 from tkinter import ttk
-from tkinter import colorchooser
-from tkinter.colorchooser import askcolor
 #from tkinter import commondialog
 #import tkfontchooser
 #from tkfontchooser import askfont
@@ -99,19 +99,41 @@ import os
 import string
 from random import *
 
+# Modules that are not needed to show the window are imported when they are first used, so that the window appears
+# as soon as possible (see --startup-time; 'python -X importtime' breaks it down by module). vault imports
+# cryptography on first use for the same reason.
+import importlib
+
+class LazyModule:
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
 # To open OnScreen Keyboard on Windows
-import platform
-import subprocess
+platform = LazyModule('platform')
+subprocess = LazyModule('subprocess')
 # subprocess.Popen(['osk'], shell=True) # Windows
 # os.system('open -a KeyboardViewer') # Mac
 
+colorchooser = LazyModule('tkinter.colorchooser')
+
 # To encrypt / decrypt the files
-import base64
-from base64 import binascii
-from cryptography.hazmat.backends import default_backend
-from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
-from cryptography.fernet import Fernet, InvalidToken
+import vault
+
+# To open/save files without freezing the window
+import threading
+concurrent_futures = LazyModule('concurrent.futures')
+multiprocessing = LazyModule('multiprocessing') # Search in Files searches the files in worker processes
+mmap = LazyModule('mmap') # The large file viewer maps the file rather than reading it
+locale = LazyModule('locale')
+socket = LazyModule('socket') # Later launches hand their files over to the first (see hand_over)
+secrets = LazyModule('secrets')
+queue = LazyModule('queue')
 
 # There are three Reg Ex packages that can be used: Tcl (Tkinter built-in), re (Python built-in), regex (Python package that intend to replace re in the future)
 #  - Tcl can do backward search but cannot do symbolic substitution
@@ -124,11 +146,16 @@ from cryptography.fernet import Fernet, InvalidToken
 
 # https://bugs.python.org/issue516762
 # https://pypi.org/project/regex/
-import regex as re # This is *different* from 'import re'
-import webbrowser # To create a hyperlink to a regex tutorial website
+re = LazyModule('regex') # This is *different* from 'import re'
+webbrowser = LazyModule('webbrowser') # To create a hyperlink to a regex tutorial website
 
 import configparser
 import ast
+from collections import OrderedDict
+import itertools
+import bisect
+import array
+IMPORTED = time.perf_counter()
 
 
 # https://stackoverflow.com/questions/214359/converting-hex-color-to-rgb-and-vice-versa
@@ -207,10 +234,313 @@ class ConfigParser2(configparser.ConfigParser):
         f.close()
 
 
+# Compiled patterns of Find/Replace by (pattern, ignore case, whole word, backwards), so that pressing F3 again and
+# again does not compile the same pattern every time. The least recently used pattern is dropped beyond size.
+class PatternCache:
+    def __init__(self, size=32):
+        self.size = size
+        self.patterns = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    # Raises re.error for a bad pattern (which is not cached)
+    def get(self, pattern, ignorecase, wholeword, backwards):
+        key = (pattern, ignorecase, wholeword, backwards)
+        if key in self.patterns:
+            self.hits += 1
+            self.patterns.move_to_end(key)
+            return self.patterns[key]
+        self.misses += 1
+        # https://stackoverflow.com/questions/4154961/find-substring-in-string-but-only-if-whole-words
+        if wholeword:
+            pattern = r'\b' + pattern + r'\b'
+        if backwards:
+            pattern = '(?r)' + pattern
+        # https://stackoverflow.com/questions/500864/case-insensitive-regular-expression-without-re-compile
+        compiled = re.compile(pattern, re.MULTILINE|re.IGNORECASE if ignorecase else re.MULTILINE)
+        self.patterns[key] = compiled
+        if len(self.patterns) > self.size:
+            self.patterns.popitem(last=False)
+        return compiled
+
+    def clear(self):
+        self.patterns.clear()
+
+
+# A copy of the text of the Text widget in Python, kept up to date from the edits (see Notepad._on_text_command), so
+# that a search gets the text without Tk building it (and converting it from Tcl) every time, and turns its matches
+# into indices without Tk walking the text character by character. Offsets count characters from the start of the text;
+# indices are 'line.column'.
+# The copy is made the first time a search needs it (not while a file is loaded, see forget), and is then kept as a list
+# of lines, which an edit changes in place; text() joins them into one string for the regex, which is a copy of the
+# whole text again after every edit (made once per version and kept until the next edit).
+class TextMirror:
+    def __init__(self, load):
+        self.load = load     # returns the whole text, for when the edits are not known (undo/redo)
+        self.lines = None    # the text split at newlines (None: load it again)
+        self.version = 0     # incremented by every edit
+        self._text = None    # the lines joined (None: join them again)
+        self._starts = None  # offset of the start of each line in _text (array)
+
+    # Drop the copy until it is needed again (when a file is opened or closed)
+    def forget(self):
+        self.version += 1
+        self.lines = self._text = self._starts = None
+
+    def apply(self, edits):
+        self.version += 1
+        self._text = self._starts = None
+        for edit in edits:
+            if self.lines is None:
+                break
+            if edit[0] == 'insert':
+                line, col = self._position(edit[1])
+                self.lines[line:line+1] = (self.lines[line][:col] + edit[2] + self.lines[line][col:]).split('\n')
+            elif edit[0] == 'delete':
+                line1, col1 = self._position(edit[1])
+                line2, col2 = self._position(edit[2])
+                self.lines[line1:line2+1] = [self.lines[line1][:col1] + self.lines[line2][col2:]]
+            else:
+                self.lines = None
+
+    # (line, column) from 0 in lines. Text inserted at 'end' goes before the last newline, as Tk does.
+    def _position(self, index):
+        line, col = (int(i) for i in index.split('.'))
+        if line > len(self.lines):
+            return len(self.lines) - 1, len(self.lines[-1])
+        return line - 1, col
+
+    def text(self):
+        if self._text is None:
+            if self.lines is None:
+                self._text = self.load()
+                self.lines = self._text.split('\n')
+            else:
+                self._text = '\n'.join(self.lines)
+            self._starts = array.array('q', itertools.accumulate((len(line) + 1 for line in self.lines[:-1]), initial=0))
+        return self._text
+
+    # index must be 'line.column' (as returned by Text.index)
+    def offset(self, index):
+        self.text()
+        line, col = self._position(index)
+        return self._starts[line] + col
+
+    def index(self, offset):
+        self.text()
+        line = bisect.bisect_right(self._starts, offset) - 1
+        return '%d.%d' % (line + 1, offset - self._starts[line])
+
+    # The offsets of the starts of the lines of this version, which the next edit does not change (a new array is made)
+    def line_starts(self):
+        self.text()
+        return self._starts
+
+
+# The matches of Find All, for the Notepad to tag a block of BLOCK matches (one call to Tk) at a time around the view
+# (see Notepad._tag_found). They come as offsets in the text they were found in, and the blocks not tagged yet follow
+# the edits since then (see apply) in lines and columns, which takes no text: a block above all the edits only has its
+# line numbers moved, and a block that an edit reaches is turned into indices and moved match by match.
+class FoundMatches:
+    BLOCK = 256
+
+    def __init__(self, starts, ends, line_starts):
+        self.starts = starts
+        self.ends = ends
+        self.line_starts = line_starts # of the text the offsets are in
+        # [first line, last line, lines added above] of each block (None once tagged), and (line, column) pairs of the
+        # matches of the blocks an edit has reached
+        self.lines = []
+        self.indices = {}
+        for i in range(0, len(starts), self.BLOCK):
+            self.lines.append([self._position(starts[i])[0], self._position(ends[min(i + self.BLOCK, len(ends)) - 1])[0], 0])
+
+    def _position(self, offset):
+        line = bisect.bisect_right(self.line_starts, offset)
+        return line, offset - self.line_starts[line - 1]
+
+    # [(line, column) of the start, of the end] of the matches of a block that no edit has reached
+    def _matches(self, block, added):
+        matches = []
+        for i in range(block*self.BLOCK, min((block + 1)*self.BLOCK, len(self.starts))):
+            (line1, col1), (line2, col2) = self._position(self.starts[i]), self._position(self.ends[i])
+            matches.append([(line1 + added, col1), (line2 + added, col2)])
+        return matches
+
+    # Edits as described by Notepad._on_text_command. Returns False after undo/redo, whose changes are not known.
+    def apply(self, edits):
+        for edit in edits:
+            if edit[0] == 'insert':
+                p1 = p2 = tuple(int(i) for i in edit[1].split('.'))
+                newlines = edit[2].count('\n')
+                e = (p1[0] + newlines, len(edit[2]) - edit[2].rfind('\n') - 1 if newlines else p1[1] + len(edit[2]))
+            elif edit[0] == 'delete':
+                p1, p2 = (tuple(int(i) for i in index.split('.')) for index in edit[1:3])
+                e = p1
+            else:
+                return False
+            for block, lines in enumerate(self.lines):
+                if lines is None or lines[1] < p1[0]:
+                    continue
+                if lines[0] > p2[0] and block not in self.indices:
+                    lines[0] += e[0] - p2[0]
+                    lines[1] += e[0] - p2[0]
+                    lines[2] += e[0] - p2[0]
+                    continue
+                matches = self.indices.get(block)
+                if matches is None:
+                    matches = self.indices[block] = self._matches(block, lines[2])
+                for match in matches:
+                    # Text inserted at either end of a match stays out of it (as with Tk tags)
+                    match[0] = self._move(match[0], p1, p2, e, True)
+                    match[1] = self._move(match[1], p1, p2, e, False)
+                lines[0], lines[1] = matches[0][0][0], matches[-1][1][0]
+        return True
+
+    # Where position pos goes when the text from p1 to p2 is replaced by text that ends at e
+    @staticmethod
+    def _move(pos, p1, p2, e, right):
+        if pos > p2 or pos == p2 and (right or p1 != p2):
+            return (e[0], e[1] + pos[1] - p2[1]) if pos[0] == p2[0] else (pos[0] + e[0] - p2[0], pos[1])
+        return min(pos, p1)
+
+    # Yield the ranges (indices) of the matches of each block within lines first to last that is not tagged yet, for Tk
+    # to tag them now
+    def take(self, first, last):
+        for block, lines in enumerate(self.lines):
+            if lines is None or lines[1] < first or lines[0] > last:
+                continue
+            self.lines[block] = None
+            matches = self.indices.pop(block, None)
+            if matches is None:
+                matches = self._matches(block, lines[2])
+            ranges = []
+            for start, end in matches:
+                if start < end: # Empty matches (e.g. of '^') are counted but have nothing to tag
+                    ranges += ['%d.%d' % start, '%d.%d' % end]
+            yield ranges
+
+
+# A plain text file mapped into memory rather than read, for the large file viewer (see Notepad.LargeFileViewer), so
+# that a file of any size is shown and searched without the memory for its text. Offsets count bytes from the start of
+# the file. Lines are found by looking for newlines around an offset; the line number of an offset comes from the
+# number of newlines before each BLOCK bytes, which count() counts in the background.
+class MappedText:
+    BLOCK = 1 << 16    # bytes per entry of newlines
+    CHUNK = 1 << 20    # bytes searched at a time by find()
+    OVERLAP = 1 << 12  # bytes of the longest match find() finds, and of the text it sees on either side of a CHUNK
+    LINE_MAX = 1 << 12 # bytes of a line that are shown
+
+    def __init__(self, fpath, encoding):
+        with open(fpath, 'rb') as file:
+            self.size = os.fstat(file.fileno()).st_size
+            self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) if self.size > 0 else b'' # mmap cannot map 0 bytes
+        self.encoding = encoding
+        self.newlines = array.array('q') # number of newlines before each block, as far as counted
+        self.lines = None                # number of lines, once all are counted
+        self.stopped = False             # set to stop count()
+
+    def close(self):
+        if self.size > 0:
+            self.map.close()
+
+    def count(self):
+        count = 0
+        for start in range(0, self.size, self.BLOCK):
+            if self.stopped:
+                return
+            self.newlines.append(count)
+            count += self.map[start:start+self.BLOCK].count(b'\n')
+        self.lines = count + 1
+
+    # Line number (from 1) of offset, or None if it is not counted yet
+    def line_number(self, offset):
+        block = offset // self.BLOCK
+        if block >= len(self.newlines):
+            return None if self.lines is None else self.lines
+        return self.newlines[block] + self.map[block*self.BLOCK:offset].count(b'\n') + 1
+
+    def line_start(self, offset):
+        return self.map.rfind(b'\n', 0, offset) + 1
+
+    # Start of the next (previous) line of the line that starts at offset, or None at the last (first) line
+    def next_line(self, offset):
+        end = self.map.find(b'\n', offset)
+        return None if end < 0 else end + 1
+
+    def previous_line(self, offset):
+        return self.line_start(offset - 1) if offset > 0 else None
+
+    def decode(self, start, end):
+        return self.map[start:min(end, start + self.LINE_MAX)].decode(self.encoding, 'replace')
+
+    # (start, text) of up to count lines from the line that starts at offset
+    def lines_from(self, offset, count):
+        lines = []
+        while offset is not None and len(lines) < count:
+            end = self.map.find(b'\n', offset)
+            lines.append((offset, self.decode(offset, self.size if end < 0 else end).rstrip('\r')))
+            offset = None if end < 0 else end + 1
+        return lines
+
+    # (start, end) of the first match of the compiled bytes pattern p after offset (the last one before it if backwards,
+    # for which p must be compiled with REVERSE), or None. The file is searched a CHUNK at a time, with OVERLAP bytes
+    # more on either side for '^', '$' and lookaround, so memory does not grow with the file or its lines; a match that
+    # runs into the cut end of the bytes searched (longer than OVERLAP) is not taken.
+    # Stops (returns None) when cancel is set; raises TimeoutError after timeout seconds.
+    def find(self, p, offset, backwards=False, cancel=None, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        def left():
+            return None if deadline is None else max(deadline - time.monotonic(), 0.001)
+        if not backwards:
+            start = offset
+            while start < self.size or start == offset:
+                if cancel is not None and cancel.is_set():
+                    return None
+                low, high = max(start - self.OVERLAP, 0), min(start + self.CHUNK + self.OVERLAP, self.size)
+                data = self.map[low:high]
+                pos = start - low
+                while True:
+                    match = p.search(data, pos, timeout=left(), concurrent=True)
+                    if match is None or match.start() >= start + self.CHUNK - low: # Left to the next chunk
+                        break
+                    if match.end() < len(data) or high == self.size:
+                        return low + match.start(), low + match.end()
+                    pos = match.start() + 1
+                start += self.CHUNK
+            return None
+        limit = offset # A match must end by limit
+        while True:
+            if cancel is not None and cancel.is_set():
+                return None
+            low, high = max(limit - self.CHUNK - self.OVERLAP, 0), min(limit + self.OVERLAP, self.size)
+            for match in p.finditer(self.map[low:high], timeout=left(), concurrent=True): # From the end
+                if match.start() == 0 and low > 0:
+                    break
+                if low + match.end() <= limit:
+                    return low + match.start(), low + match.end()
+            if low == 0:
+                return None
+            limit -= self.CHUNK
+
+
 class Notepad(ttk.Frame):
-    def __init__(self, *args, cp='', salt=b'salt_', iterations=100000, **kwargs):
+    def __init__(self, *args, cp='', salt=b'salt_', iterations=100000, key_cache=None, **kwargs):
         ttk.Frame.__init__(self, *args, **kwargs)
         self.text = tk.Text(self, undo=True, autoseparators=True)
+        # Replace the widget command of the Text with _on_text_command, which passes every call on to the original
+        # (renamed) command and tells _edit_listeners about the edits (see _on_text_command)
+        self._text_command = self.text._w + '_orig'
+        self.tk.call('rename', self.text._w, self._text_command)
+        self.tk.createcommand(self.text._w, self._on_text_command)
+        self._edit_listeners = []
+        self.mirror = TextMirror(lambda: self.text.get('1.0', 'end-1c'))
+        self._edit_listeners.append(self.mirror.apply)
+        # Character counts for the status bar, kept up to date from the edits rather than counted on every event
+        self._nchars = 0         # characters in the text (None: count them again)
+        self._edits = 0          # edits so far, which tells whether the indices in _selection are still valid
+        self._selection = None   # (sel.first, sel.last, characters, _edits) when the selection was last counted
+        self._edit_listeners.append(self._on_count_edit)
         self.vscroll = ttk.Scrollbar(self, orient='vertical')
         self.hscroll = ttk.Scrollbar(self, orient='horizontal')
         self.menu = tk.Menu(self)
@@ -228,6 +558,13 @@ class Notepad(ttk.Frame):
         self.status.count.grid(row=1, column=2, sticky='sew')
         #self.status.encoding = tk.Label(self.status, bd=1, relief='sunken', text='', anchor='w')
         #self.status.encoding.grid(row=1, column=3, sticky='sew')
+        # Progress bar and Cancel button, shown only while a file is opened/saved in the background
+        self.status.busy = ttk.Frame(self.status)
+        self.status.progress = ttk.Progressbar(self.status.busy, mode='indeterminate', length=100)
+        self.status.progress.pack(side='left', fill='y')
+        ttk.Button(self.status.busy, text='Cancel', width=7, command=self._on_cancel).pack(side='left')
+        self.status.busy.show = lambda: self.status.busy.grid(row=1, column=3, sticky='sew')
+        self.status.busy.hide = lambda: self.status.busy.grid_forget()
 
         # Evenly space status bars
         # https://webcache.googleusercontent.com/search?q=cache:3h0isl3ZrqEJ:https://www.e-learn.cn/topic/3015315+&cd=4&hl=en&ct=clnk&gl=us&client=firefox-b-1-d
@@ -249,32 +586,48 @@ class Notepad(ttk.Frame):
         self.grid_rowconfigure(0, weight=1)
         self.vscroll.config(command=self.text.yview)
         self.hscroll.config(command=self.text.xview)
-        self.text.configure(yscrollcommand=self.vscroll.set)
+        self.text.configure(yscrollcommand=self._on_yscroll)
         self.text.configure(xscrollcommand=self.hscroll.set)
 
         #self.text.bind('<<CursorChange>>', self._on_change)
         #self.text.bind('<<Selection>>', self._on_change)
 
-        # Beware that these hacks do not support direct text/cursor modifications by executing insert(), tag_add('sel'), etc.
-        self.text.bind('<KeyRelease>', self._on_change)
-        self.text.bind('<ButtonRelease-1>', self._on_change)
-        self.text.bind('<B1-Motion>', self._on_change)
+        # The status bar and the title are updated from _on_text_command, which sees every change of the text, the cursor
+        # and the selection (by keys, the mouse and code alike)
         self.text.bind('<<Selection>>', self._on_selection)
+        self._status_job = None # pending _update_status
+        self._shown = {}        # what the status bar and the title show now
 
         self.fpath = ''         # file path
         self.fname = 'Untitled' # file name
         self.key1 = None        # master key for read-only key encryption
         self.key2 = None        # read-only key for text encryption
         self.salt = salt        # sald for encryption
-        self.iter = iterations  # iterations for encryption
+        self.iter = iterations  # iterations for encryption of files without the header
+        self.header = None      # vault.Header of the current file if encrypted (key derivation, key slots, etc.)
+        self.blocks = vault.BlockMap() # records of the current file that Save can copy instead of encrypting again
+        self._pool = None # see pool
+        self._search_pool = None # see search_pool
+        self._busy = False               # True while waiting for the pool
+        self._cancel = threading.Event() # set by the Cancel button
+        self.journal = None              # vault.Journal of the current file (only for a file opened with the master password)
+        self._journal_edits = []         # edits not yet written to the journal
+        self._journal_snapshot = False   # True if the whole text is to be written instead (after undo/redo)
+        self._journal_timer = None
+        self._journal_since = None       # time of the first edit in the journal
+        self._edit_listeners.append(self._on_journal_edit)
         #self.text.tag_configure('match', foreground='white', background='royal blue')
         self.text.tag_configure('match', foreground=self.text.tag_cget('sel', 'foreground'), background=self.text.tag_cget('sel', 'background'))
         self.text.tag_configure('find all', background='orange red')
+        self._found = None # matches of Find All (see _show_found)
+        self._edit_listeners.append(self._on_found_edit)
         self.text.tag_raise('sel')
 
         self.rect_select_on = tk.BooleanVar()
         self.wrap_type = tk.IntVar()
         self.status_on = tk.BooleanVar()
+        self.journal_on = tk.BooleanVar()
+        self.search_index = tk.BooleanVar()
 
         # use configparser to load settings
         self.cp = cp
@@ -293,6 +646,12 @@ class Notepad(ttk.Frame):
             background=self.cp.get2('settings', 'background_color', self.text.cget('background'))
         )
         self.text.tag_configure('normal', background=self.text.cget('background'))
+        self.text.mark_set('normal.first', '1.0') # the lines with the 'normal' tag (see _on_selection)
+        self.text.mark_set('normal.last', '1.0')
+        self.text.mark_gravity('normal.first', 'left')
+        self.text.mark_gravity('normal.last', 'right')
+        self._view_job = None
+        self._edit_listeners.append(self._on_selection)
         # adjust the cursor color
         if rgb_to_brightness(self.winfo_rgb(self.text.cget('background'))) > 0.5: # Bright => Make the cursor black
             self.text.config(insertbackground='black')
@@ -301,16 +660,48 @@ class Notepad(ttk.Frame):
         # misc
         self.wrap_type.set(self.cp.getint2('settings', 'wrap_type', 0))
         self.status_on.set(self.cp.getboolean2('settings', 'status_bar', True))
-        # search settings
-        self.fr = self.FindReplace(self,
+        # derived keys are cached so that reopening a file does not cost another key derivation
+        # (the windows opened for later launches share the cache of the first, see open_window)
+        self.key_cache = key_cache if key_cache is not None else vault.KeyCache(
+            ttl=self.cp.getint2('settings', 'key_cache_ttl', 300), # seconds of idleness; 0 disables the cache
+            maxsize=self.cp.getint2('settings', 'key_cache_size', 8)
+        )
+        self.after(30000, self._on_key_cache_timer)
+        # key derivation for newly encrypted files (set by File > Key Derivation...)
+        try:
+            self.kdf_setting = ast.literal_eval(self.cp.get2('settings', 'kdf', str(vault.kdf_to_dict(vault.legacy_kdf(self.iter), salt=False))))
+            vault.kdf_from_dict(self.kdf_setting, salt=b'')
+        except (ValueError, SyntaxError, vault.FormatError):
+            self.kdf_setting = vault.kdf_to_dict(vault.legacy_kdf(self.iter), salt=False)
+            self.cp.set('settings', 'kdf', str(self.kdf_setting))
+        # compression for newly encrypted files (set by File > Compression...), (codec, level) or None
+        # (whether the codec is installed is checked when a file is saved, not to import zstandard here)
+        try:
+            self.compression_setting = ast.literal_eval(self.cp.get2('settings', 'compression', str((vault.ZLIB, 6))))
+            if self.compression_setting is not None:
+                self.compression_setting = vault.check_compression(self.compression_setting)
+        except (ValueError, SyntaxError, TypeError, vault.FormatError):
+            self.compression_setting = (vault.ZLIB, 6)
+            self.cp.set('settings', 'compression', str(self.compression_setting))
+        # search settings (the Find/Replace window itself is created on first use, see fr)
+        self._fr = None
+        self._fr_settings = dict(
             ignorecase=self.cp.getboolean2('settings', 'ignore_case', True),
             wholeword=self.cp.getboolean2('settings', 'whole_word', False),
             withinsel=self.cp.getboolean2('settings', 'within_selection', False),
             regexp=self.cp.getboolean2('settings', 'regular_expression', False)
         )
-        self.fr.withdraw()
+        self.search_timeout = self.cp.getint2('settings', 'search_timeout', 10) # seconds before a search gives up
+        if self.search_timeout < 1: # A search must end, since it cannot be stopped otherwise (see search_pool)
+            self.search_timeout = 10
+            self.cp.set('settings', 'search_timeout', str(self.search_timeout))
+        self.large_file_size = self.cp.getint2('settings', 'large_file_size', 64) # MiB from which a plain text file may go to the large file viewer (0: never)
         # recent files
         self.recent_files = ast.literal_eval(self.cp.get2('settings', 'recent_files', '[]'))
+        self.binary_file = self.cp.getboolean2('settings', 'binary_file', False) # Default of the container in Save As
+        self.journal_on.set(self.cp.getboolean2('settings', 'journal', True))
+        self.search_index.set(self.cp.getboolean2('settings', 'search_index', True))
+        self.after(60000, self._on_journal_timer)
 
         self.menu_file = tk.Menu(self.menu, tearoff=0)
         self.menu.add_cascade(label='File', underline=0, menu=self.menu_file)
@@ -335,6 +726,13 @@ class Notepad(ttk.Frame):
         self.menu_recent.add_separator()
         self.menu_recent.add_command(label='Clear Recent Files', underline=0, command=self._on_clear_recent_files)
         self.menu_file.add_separator()
+        self.menu_file.add_command(label='Key Derivation...', underline=0, command=self._on_key_derivation)
+        self.menu_file.add_command(label='Compression...', underline=3, command=self._on_compression)
+        self.menu_file.add_checkbutton(label='Journal Unsaved Edits', underline=0, onvalue=1, offvalue=0, variable=self.journal_on, command=self._on_journal)
+        self.menu_file.add_checkbutton(label='Index for Search in Files', underline=0, onvalue=1, offvalue=0, variable=self.search_index,
+            command=lambda: self.cp.set('settings', 'search_index', str(self.search_index.get())))
+        self.menu_file.add_command(label='Lock', underline=0, command=self._on_lock, accelerator='Ctrl+L')
+        self.text.bind('<Control-l>', self._on_lock)
         self.menu_file.add_command(label='Exit', underline=1, command=self._on_exit, accelerator='Alt+F4')
 
         self.menu_edit = tk.Menu(self.menu, tearoff=0)
@@ -355,6 +753,8 @@ class Notepad(ttk.Frame):
         self.text.bind('<F3>', self._on_find_next)
         self.menu_edit.add_command(label='Find Previous', underline=8, command=self._on_find_previous, accelerator='Shift+F3')
         self.text.bind('<Shift-F3>', self._on_find_previous)
+        self.menu_edit.add_command(label='Search in Files...', underline=0, command=self._on_search_files, accelerator='Ctrl+Shift+F')
+        self.text.bind('<Control-F>', self._on_search_files)
         self.menu_edit.add_separator()
         self.menu_edit.add_command(label='Select All', underline=7, command=self._on_select_all, accelerator='Ctrl+A')
         self.menu_edit.add_command(label='Insert Time/Date', underline=5, command=self._on_time_date, accelerator='F5')
@@ -389,37 +789,117 @@ class Notepad(ttk.Frame):
         self._on_word_wrap()
         self._on_change()
 
-        # Quick file checker of Base64 URL-safe decoding
-        self.b64re = re.compile(r'^[A-Za-z0-9_=-]*$')
-
 
+    # Any number of changes until Tk is idle (a key repeat, a paste, a replace all) come down to one update, and only the
+    # labels whose text differs are touched
     def _on_change(self, event=None):
+        if self._status_job is None:
+            self._status_job = self.after_idle(self._update_status)
+
+    def _update_status(self):
+        self._status_job = None
         # Statusbar update 1
         line, char = self.text.index('insert').split('.')
-        self.status.cursor.configure(text='Ln %s, Col %d' % (line, int(char)+1))
+        self._show('cursor', 'Ln %s, Col %d' % (line, int(char)+1))
         # Statusbar update 2
         if self.text.tag_ranges('sel'):
-            nchars = len(self.text.get('sel.first', 'sel.last'))
-            message = str(nchars) + ' Chars Selected'
+            message = str(self._count_selection()) + ' Chars Selected'
         else:
-            nchars = len(self.text.get('1.0', 'end-1c'))
-            message = str(nchars) + ' Chars Total'
-        self.status.count.configure(text=message)
+            if self._nchars is None:
+                self._nchars = len(self.text.get('1.0', 'end-1c'))
+            message = str(self._nchars) + ' Chars Total'
+        self._show('count', message)
         # Title update
         if self.text.edit_modified():
-            root.title('*' + self.fname + ' - Encrypted Notepad')
+            self._show('title', '*' + self.fname + ' - Encrypted Notepad')
         elif self.text.cget('state') == 'disabled':
-            root.title(self.fname + ' (Read Only) - Encrypted Notepad')
+            self._show('title', self.fname + ' (Read Only) - Encrypted Notepad')
         else:
-            root.title(self.fname + ' - Encrypted Notepad')
+            self._show('title', self.fname + ' - Encrypted Notepad')
 
+    def _show(self, name, text):
+        if self._shown.get(name) != text:
+            self._shown[name] = text
+            if name == 'title':
+                self.winfo_toplevel().title(text)
+            else:
+                getattr(self.status, name).configure(text=text)
+
+    def _on_count_edit(self, edits):
+        self._edits += 1
+        for edit in edits:
+            if self._nchars is None:
+                break
+            if edit[0] == 'insert':
+                self._nchars += len(edit[2])
+            elif edit[0] == 'delete':
+                self._nchars -= edit[3]
+            else: # Undo/redo
+                self._nchars = None
+
+    # Count the selected characters in Tk (without copying them out), and only the difference from the last count if
+    # one end of the selection stayed where it was (as it does while the selection is dragged or extended)
+    def _count_selection(self):
+        ranges = self.text.tag_ranges('sel')
+        first, last = str(ranges[0]), str(ranges[-1])
+        count = lambda index1, index2: int(self.text.tk.call(self.text._w, 'count', '-chars', index1, index2) or 0) # Negative if index1 > index2
+        if self._selection is not None and self._selection[3] == self._edits and first == self._selection[0]:
+            nchars = self._selection[2] + count(self._selection[1], last)
+        elif self._selection is not None and self._selection[3] == self._edits and last == self._selection[1]:
+            nchars = self._selection[2] + count(first, self._selection[0])
+        else:
+            nchars = count(first, last)
+        self._selection = (first, last, nchars, self._edits)
+        return nchars
+
+    # A selected newline is painted to the right edge of the window, so newlines get the 'normal' tag (above 'sel') with
+    # the background color. Only the visible ones need it: the tag is kept on the visible lines, between the marks
+    # 'normal.first' and 'normal.last' (which move with the text, and take in what is inserted at them), and moved there
+    # once the view, the selection or the text has changed. The matches of Find All around the view are tagged then too.
     def _on_selection(self, event=None):
-        self.text.tag_remove('normal', '1.0', 'end')
-        # apply 'tag_add' to all newline characters in selection
-        n_lines = self.text.index('end-1c').split('.')[0]
-        for i in range(int(n_lines)):
-            line_end_index = '%d.end' % (i + 1)
-            self.text.tag_add('normal', line_end_index, line_end_index+'+1c')
+        if self._view_job is None:
+            self._view_job = self.after_idle(self._tag_view)
+
+    def _tag_view(self):
+        self._view_job = None
+        self.text.tag_remove('normal', 'normal.first', 'normal.last') # Also from text inserted between tagged newlines
+        first = int(self.text.index('@0,0').split('.')[0])
+        last = int(self.text.index('@0,%d' % self.text.winfo_height()).split('.')[0])
+        ranges = []
+        for i in range(first, last + 1):
+            ranges += ['%d.end' % i, '%d.end+1c' % i]
+        self.text.tag_add('normal', *ranges)
+        self.text.mark_set('normal.first', '%d.0' % first)
+        self.text.mark_set('normal.last', '%d.end+1c' % last)
+        self._tag_found(first, last)
+
+    # Find All keeps its matches (see FoundMatches), and tags only those within a screen of the view, so that a pattern
+    # matching all over a large text neither waits for all the tags nor leaves Tk with all of them. The tags move with
+    # the text, and the matches not tagged yet are moved along by the edits (see _on_found_edit); after undo/redo they
+    # are dropped.
+    def _show_found(self, starts, ends):
+        self._found = FoundMatches(starts, ends, self.mirror.line_starts())
+        self._on_selection()
+
+    def _clear_found(self):
+        self._found = None
+        self.text.tag_remove('find all', '1.0', 'end')
+
+    def _on_found_edit(self, edits):
+        if self._found is not None and not self._found.apply(edits):
+            self._found = None
+
+    def _tag_found(self, first, last):
+        if self._found is None:
+            return
+        margin = last - first + 1
+        for ranges in self._found.take(first - margin, last + margin):
+            if ranges:
+                self.text.tag_add('find all', *ranges)
+
+    def _on_yscroll(self, first, last):
+        self.vscroll.set(first, last)
+        self._on_selection()
 
     def _update_recent_files(self, fpath):
         # If fpath exists in the current recent files, delete it
@@ -457,6 +937,8 @@ class Notepad(ttk.Frame):
             self.cp.set('settings', 'recent_files', str(self.recent_files))
 
     def _on_new_file(self, event=None):
+        if self._busy:
+            return
         if self.text.edit_modified():
             ans = tk.messagebox.askyesnocancel('Encrypted Notepad', 'Do you want to save changes to ' + self.fname + '?')
             if ans: # Yes
@@ -464,19 +946,229 @@ class Notepad(ttk.Frame):
                     return
             elif ans is None: # Cancel => Return to window
                 return
+        self._close_file()
+        return True
+
+    def _close_file(self):
+        self._stop_journal()
         self.fpath = ''
         self.fname = 'Untitled'
         self.key1 = None
         self.key2 = None
+        self.header = None
+        self.blocks.clear()
         self.text.configure(state='normal')
         self.text.delete('1.0', 'end')
+        self.mirror.forget()
         self.text.edit_reset()
         self.text.focus_set()
         self.text.edit_modified(False)
         self._on_change()
 
+    # Close the current file and forget all cached keys, so the next open asks for a full key derivation again
+    def _on_lock(self, event=None):
+        if self._on_new_file():
+            self.key_cache.flush()
+
+    def _on_key_cache_timer(self):
+        self.key_cache.expire()
+        self.after(30000, self._on_key_cache_timer)
+
+    # Tk has no event for changes of the text, so every call to the widget command comes here (see __init__). Edits are
+    # described with the indices before the edit, which is enough to do them again on the saved text:
+    # ('insert', index, chars), ('delete', index1, index2, number of characters deleted), or ('reset',) after undo/redo,
+    # whose changes Tk makes without going through the widget command. Typing, pasting and code are all caught alike.
+    def _on_text_command(self, *args):
+        edits = None
+        if self._edit_listeners and args and args[0] in ('insert', 'delete', 'replace', 'edit'):
+            try:
+                edits = self._describe_edit(args)
+            except tk.TclError: # Bad index etc. => The original command raises the error
+                pass
+        result = self.tk.call((self._text_command,) + args)
+        if edits:
+            for listener in self._edit_listeners:
+                listener(edits)
+        if args and (args[0] in ('insert', 'delete', 'replace') or args[:3] == ('mark', 'set', 'insert')
+                or args[:3] in (('tag', 'add', 'sel'), ('tag', 'remove', 'sel')) or args[:2] in (('edit', 'undo'),
+                ('edit', 'redo')) or args[:2] == ('edit', 'modified') and len(args) > 2):
+            self._on_change()
+        return result
+
+    def _describe_edit(self, args):
+        call = lambda *a: str(self.tk.call((self._text_command,) + a))
+        if args[0] == 'edit':
+            return [('reset',)] if args[1:2] in (('undo',), ('redo',)) else None
+        if call('cget', '-state') == 'disabled':
+            return None
+        if args[0] == 'insert':
+            return [('insert', call('index', args[1]), ''.join(args[2::2]))]
+        if args[0] == 'delete':
+            if len(args) > 3: # Several ranges
+                return [('reset',)]
+            delete = self._describe_delete(call, args[1], args[2] if len(args) > 2 else args[1] + '+1c')
+            return [delete] if delete else None
+        index1 = call('index', args[1])
+        delete = self._describe_delete(call, index1, args[2])
+        return ([delete] if delete else []) + [('insert', index1, ''.join(args[3::2]))]
+
+    # The range Tk actually deletes: the final newline is never deleted, and a range from the start of a line to the
+    # end takes the newline before it instead (see DeleteIndexRange() in tkText.c)
+    def _describe_delete(self, call, index1, index2):
+        index1, index2 = call('index', index1), call('index', index2)
+        if call('compare', index1, '>=', index2) == '1':
+            return None
+        if index2 == call('index', 'end'):
+            index2 = call('index', 'end-1c')
+            if index1.endswith('.0') and index1 != '1.0':
+                index1 = call('index', index1 + '-1c')
+            if call('compare', index1, '>=', index2) == '1':
+                return None
+        return ('delete', index1, index2, len(self.tk.call(self._text_command, 'get', index1, index2)))
+
+    # Edit journal
+    # Edits are collected here and written as one journal record at most once a second (by the journal's own thread).
+    # A save starts a new journal for the saved file, and Open offers to replay a journal left by a crash.
+    def _on_journal_edit(self, edits):
+        if self.journal is None:
+            return
+        if edits[0][0] == 'reset':
+            self._journal_snapshot = True
+            self._journal_edits = []
+        elif not self._journal_snapshot:
+            self._journal_edits.extend(edit[:3] for edit in edits) # Without the number of deleted characters
+        if self._journal_timer is None:
+            self._journal_timer = self.after(1000, self._flush_journal)
+
+    def _flush_journal(self):
+        if self._journal_timer is not None:
+            self.after_cancel(self._journal_timer)
+            self._journal_timer = None
+        if self.journal is None or not (self._journal_edits or self._journal_snapshot):
+            return
+        if self._busy: # Saving => The edits go to the journal of the saved file
+            self._journal_timer = self.after(1000, self._flush_journal)
+            return
+        if self._journal_snapshot:
+            self._journal_edits = [('text', self.text.get('1.0', 'end-1c'))]
+        self.journal.append(self._journal_edits)
+        self._journal_edits = []
+        self._journal_snapshot = False
+        if self._journal_since is None:
+            self._journal_since = time.monotonic()
+
+    # Start a journal for the file just opened or saved (with the master password), replacing the current one
+    # If resume is given (see vault.read_journal), the journal is continued (its edits have been done again by the caller).
+    # If snapshot is True, the journal starts with the whole text because it already differs from the file.
+    def _start_journal(self, fpath, key2, header, resume=None, snapshot=False):
+        if self.journal is not None: # The file it was for has just been saved
+            self.journal.close(delete=True)
+            self.journal = None
+        if not self.journal_on.get():
+            return
+        try:
+            self.journal = vault.Journal(fpath, key2, header, resume)
+        except OSError:
+            return
+        self._journal_since = time.monotonic() if resume else None
+        self._journal_snapshot = snapshot
+        self._journal_edits = []
+        if snapshot:
+            self._flush_journal()
+
+    def _stop_journal(self, delete=True):
+        self._flush_journal()
+        if self.journal is not None:
+            self.journal.close(delete)
+            self.journal = None
+        self._journal_edits = []
+        self._journal_snapshot = False
+
+    # Through _on_text_command, so that the mirror and the counts follow (the journal is not started yet, so the edits
+    # are not journaled again)
+    def _replay_journal(self, edits):
+        for edit in edits:
+            if edit[0] == 'insert':
+                self.text.insert(edit[1], edit[2])
+            elif edit[0] == 'delete':
+                self.text.delete(edit[1], edit[2])
+            elif edit[0] == 'text':
+                self.text.delete('1.0', 'end')
+                self.text.insert('1.0', edit[1])
+
+    def _on_journal(self, event=None):
+        self.cp.set('settings', 'journal', str(self.journal_on.get()))
+        if not self.journal_on.get():
+            self._stop_journal()
+        elif self.journal is None and self.key1 and self.header is not None:
+            self._start_journal(self.fpath, self.key2, self.header, snapshot=self.text.edit_modified())
+
+    # Fold the journal into the file (by saving it) once it has grown or has been there for a while, so it stays small
+    def _on_journal_timer(self):
+        self.after(60000, self._on_journal_timer)
+        if self.journal is None or self._busy or not self.text.edit_modified() or self._journal_since is None:
+            return
+        if self.journal.size > 64 * 1024 or time.monotonic() - self._journal_since > 300:
+            self._on_save_file()
+
+    def _on_key_derivation(self, event=None):
+        if self._busy:
+            return
+        diag = KeyDerivationDialog(self, setting=self.kdf_setting)
+        if diag.result is not None:
+            self.kdf_setting = diag.result
+            self.cp.set('settings', 'kdf', str(self.kdf_setting))
+        self.text.focus_set()
+
+    def _on_compression(self, event=None):
+        if self._busy:
+            return
+        diag = CompressionDialog(self, setting=self.compression_setting)
+        if diag.result is not None:
+            self.compression_setting = diag.result if diag.result[0] else None
+            self.cp.set('settings', 'compression', str(self.compression_setting))
+        self.text.focus_set()
+
+    # Run the futures in the worker pool while keeping the window alive
+    # The caller reads like ordinary blocking code: wait_variable() runs the Tk event loop (the same way Dialog waits
+    # for its window) until all futures are done, which is checked through after(). Only the caller touches widgets.
+    # Returns the list of results, or None if the user pressed Cancel. An exception raised in a worker is re-raised here.
+    def _wait(self, message, *futures):
+        done = tk.IntVar(value=0)
+        def poll():
+            if self._cancel.is_set():
+                done.set(-1)
+            elif all(f.done() for f in futures):
+                done.set(1)
+            else:
+                self.after(50, poll)
+        self._busy = True
+        self.status.misc.configure(text=message)
+        self.status.busy.show()
+        self.status.progress.start(10)
+        poll()
+        self.wait_variable(done)
+        self.status.progress.stop()
+        self.status.busy.hide()
+        self.status.misc.configure(text='')
+        self._busy = False
+        if done.get() < 0:
+            for f in futures:
+                f.cancel() # Not started yet => Never runs; already running => Stops at the next chunk or result is discarded
+            self._cancel = threading.Event() # The old one stays set for the workers that are still running
+            return None
+        return [f.result() for f in futures]
+
+    def _on_cancel(self, event=None):
+        if self._busy:
+            self._cancel.set()
+
     # Read-only password implementation
+    # The file is read by a worker while the password dialog is open, and the key is derived by another worker while
+    # the file is still being read. Decryption also runs in a worker; only the insertion into the widget is done here.
     def _on_open_file(self, event=None, fpath=None):
+        if self._busy:
+            return
         if self.text.edit_modified():
             ans = tk.messagebox.askyesnocancel('Encrypted Notepad', 'Do you want to save changes to ' + self.fname + '?')
             if ans: # Yes
@@ -490,10 +1182,30 @@ class Notepad(ttk.Frame):
             return
         fname = os.path.basename(fpath)
         try:
-            file = open(fpath, 'r') # Open the file in the read mode
-            text = file.read()
-            file.close()
-        except IOError:
+            # The header (or its absence) tells whether the file is encrypted by reading only a few bytes
+            header = vault.sniff(fpath, self.iter)
+            if header is None and 0 < self.large_file_size <= os.path.getsize(fpath) // (1 << 20):
+                ans = tk.messagebox.askyesnocancel('Encrypted Notepad', '%s is %.1f MB. Do you want to open it read-only in the large file viewer? (No opens it in the editor.)' % (fname, os.path.getsize(fpath) / 1e6))
+                if ans: # Yes => The text of the editor stays as it is
+                    self.LargeFileViewer(self, fpath)
+                    self._update_recent_files(fpath)
+                    return
+                elif ans is None: # Cancel
+                    return
+            if header is None: # Plain text => No password, no decryption
+                results = self._wait('Opening ' + fname + '...', self.pool.submit(vault.read_text, fpath))
+            else: # Encrypted => Ask password while the file is being read
+                reading = self.pool.submit(vault.read_body, fpath, header)
+                pwd = EnterPasswordDialog(self, fname=fname).result
+                if pwd is None: # Cancel => Stop opening file and return to window
+                    reading.cancel()
+                    return
+                deriving = self.pool.submit(self.key_cache.derive, pwd, self.salt, header.kdf)
+                results = self._wait('Opening ' + fname + '...', reading, deriving)
+            if results is None: # Cancel
+                return
+            pieces = [results[0]] # Plain text (an encrypted file is replaced by the decrypted text below)
+        except (IOError, UnicodeDecodeError):
             tk.messagebox.showerror(title='Encrypted Notepad', message='I/O error. Could not open ' + fname)
             try:
                 index = self.recent_files.index(fpath)
@@ -502,88 +1214,168 @@ class Notepad(ttk.Frame):
             except ValueError:
                 pass
             return
-        else:
-            file.close()
-        try:
-            # If text can be decoded by URL-safe Base64 decoding, the file is likely to be encrypted => Ask password
-            # URL-safe Base64 encoding characters in regexp: '[a-zA-Z0-9_=-]'
-            # https://stackoverflow.com/questions/12315398/check-if-a-string-is-encoded-in-base64-using-python
-            # https://stackoverflow.com/questions/8571501/how-to-check-whether-a-string-is-base64-encoded-or-not/8571649#8571649
-            # base64.urlsafe_b64decode(text, validate=True) # validate option does not work for urlsafe version...
-
-            # If the length of the text is not a multiple of 4, then not encoded
-            if len(text) % 4 != 0:
-                raise
-
-            # If it does not contain one and only one separator '====', then not encoded (by this program)
-            # If the second part contains characters other than allowed in URL-safe Base64, then not encrypted
-            texts = text.rsplit('====')
-            if len(texts) != 2 or not self.b64re.fullmatch(texts[1]):
-                raise
-
-            # We can also check if texts[0] contains other characters, or the lengths of texts[0] and texts[1] are
-            # multiples of 4, etc. But I suspect there won't be practically relevant cases where these are helpful.
-
-            pwd = EnterPasswordDialog(self, fname=fname).result
-            if pwd is None: # Cancel => Stop opening file and return to window
-                return
-
-            kdf = PBKDF2HMAC(algorithm=hashes.SHA256(),length=32,salt=self.salt,iterations=self.iter,backend=default_backend())
-            key = base64.urlsafe_b64encode(kdf.derive(pwd.encode())) # Can only use kdf once
-            if pwd == '': # OK with no input => Try Read-Only, otherwise Open file without decryption
-                key1 = None
-                try:
-                    text = Fernet(key).decrypt(texts[0].encode()).decode()
-                    key2 = key
-                    read_only = True
-                except InvalidToken: # If Read-Only with no password fails, open without decryption
-                    key2 = None
-                    read_only = False
-                except ImportError:
-                    tk.messagebox.showerror(title='Encrypted Notepad', message='Some dlls are missing. Use "--path=...bin" option in Pyinstaller to explicitly feed the dlls.')
-            else:
-                try:
-                    key2 = Fernet(key).decrypt(texts[1].encode())
-                    text = Fernet(key2).decrypt(texts[0].encode()).decode()
-                    key1 = key
-                    read_only = False
-                except InvalidToken:
-                    try:
-                        text = Fernet(key).decrypt(texts[0].encode()).decode()
-                        key1 = None
-                        key2 = key
-                        read_only = True
-                    except InvalidToken:
-                        tk.messagebox.showerror(title='Encrypted Notepad', message='Decryption failed. Could not open ' + fname)
-                        return
-                except ImportError:
-                    tk.messagebox.showerror(title='Encrypted Notepad', message='Some dlls are missing. Use "--path=...bin" option in Pyinstaller to explicitly feed the dlls.')
+        except vault.FormatError as e:
+            tk.messagebox.showerror(title='Encrypted Notepad', message=str(e) + ' Could not open ' + fname)
+            return
+        except ImportError:
+            tk.messagebox.showerror(title='Encrypted Notepad', message='Some dlls are missing. Use "--path=...bin" option in Pyinstaller to explicitly feed the dlls.')
+            return
 
-        except:
-            # If it throws an error, open the file as is
-            key1 = None
-            key2 = None
-            read_only = False
+        key1 = None
+        key2 = None
+        read_only = False
+        blocks = vault.BlockMap()
+        if header is not None:
+            try:
+                results = self._wait('Decrypting ' + fname + '...', self.pool.submit(vault.unlock, fpath, header, results[0], pwd, results[1], self._cancel, blocks))
+                if results is None: # Cancel
+                    return
+                pieces, key1, key2, read_only = results[0]
+            except vault.DecryptionError:
+                tk.messagebox.showerror(title='Encrypted Notepad', message='Decryption failed. Could not open ' + fname)
+                return
+            except vault.FormatError as e:
+                tk.messagebox.showerror(title='Encrypted Notepad', message=str(e) + ' Could not open ' + fname)
+                return
+            except IOError:
+                tk.messagebox.showerror(title='Encrypted Notepad', message='I/O error. Could not open ' + fname)
+                return
+            except ImportError:
+                tk.messagebox.showerror(title='Encrypted Notepad', message='Some dlls are missing. Use "--path=...bin" option in Pyinstaller to explicitly feed the dlls.')
+                return
 
+        self._stop_journal()
         self.fpath = fpath
         self.fname = fname
         self.key1 = key1
         self.key2 = key2
+        self.header = header if key2 else None
+        self.blocks = blocks
         self.text.configure(state='normal')
         self.text.delete('1.0', 'end')
-        self.text.insert('end', text)
-        self.text.edit_reset() # reset undo stack
-        self.text.focus_set() # focus set on the text editor
-        self.text.mark_set('insert', '1.0') # bring set cursor to the beginning of file
-        self.text.edit_modified(False)
-        if read_only:
+        self.mirror.forget() # Until a search needs it (see TextMirror)
+        def loaded():
+            self.text.focus_set() # focus set on the text editor
+            self.text.mark_set('insert', '1.0') # bring set cursor to the beginning of file
+            self.text.edit_modified(False)
+            if key1:
+                self._open_journal(fpath, fname, key2, header)
+            if read_only:
+                self.text.configure(state='disabled')
+            self._on_change()
+            self._update_recent_files(fpath)
+        self._load(pieces, loaded)
+
+    # Insert the text of a file, and a large one a chunk per turn of the event loop, so that the window shows the first
+    # screen at once and stays responsive rather than waiting for Tk to take all of it. Until it is all in, the text is
+    # read-only, Open/Save etc. wait (see _busy), and the status bar shows the progress; Cancel closes the file.
+    # loaded() is called once the text is all in.
+    LOAD_CHUNK = 1 << 19 # characters
+
+    def _load(self, pieces, loaded):
+        total = sum(len(piece) for piece in pieces)
+        # Piece by piece rather than joined into another full-size copy
+        chunks = (piece[i:i+self.LOAD_CHUNK] for piece in pieces for i in range(0, len(piece), self.LOAD_CHUNK))
+        self.text.configure(undo=False) # Loading is not to be undone (and the undo stack would be another copy)
+        def done():
+            self.text.configure(undo=True, state='normal')
+            self.text.edit_reset() # reset undo stack
+            loaded()
+        if total <= 2*self.LOAD_CHUNK:
+            for chunk in chunks:
+                self.text.insert('end', chunk)
+            done()
+            return
+        def insert(count):
+            if self._cancel.is_set() or count == total:
+                self.status.progress.configure(mode='indeterminate', value=0)
+                self.status.busy.hide()
+                self.status.misc.configure(text='')
+                self._busy = False
+                if self._cancel.is_set():
+                    self._cancel = threading.Event()
+                    self.text.configure(undo=True)
+                    self._close_file()
+                else:
+                    done()
+                return
+            chunk = next(chunks)
+            self.text.configure(state='normal')
+            self.text.insert('end', chunk)
             self.text.configure(state='disabled')
-        self._on_change()
-        self._update_recent_files(fpath)
+            self.status.progress.configure(value=count + len(chunk))
+            self.after(1, insert, count + len(chunk))
+        self._busy = True
+        self.status.misc.configure(text='Loading...')
+        self.status.progress.configure(mode='determinate', maximum=total, value=0)
+        self.status.busy.show()
+        insert(0)
+
+    # Offer to recover the edits in the journal of a file that was not closed normally, and start journaling it
+    def _open_journal(self, fpath, fname, key2, header):
+        try:
+            resume = vault.read_journal(fpath, key2, header)
+        except OSError:
+            resume = None
+        if resume is not None and resume[0]:
+            if tk.messagebox.askyesno('Encrypted Notepad', fname + ' has unsaved edits from a previous session. Do you want to recover them?'):
+                try:
+                    self._replay_journal(resume[0])
+                except tk.TclError:
+                    tk.messagebox.showerror(title='Encrypted Notepad', message='The edits could not be recovered.')
+                    resume = None
+                else:
+                    self.text.edit_modified(True)
+            else:
+                resume = None
+        self._start_journal(fpath, key2, header, resume if resume is not None and resume[0] else None)
+
 
+    # Encrypt (if key1 is set) and write the text in a worker
+    # The modified flag is cleared when the text is taken, so edits made while the file is being written are not lost.
+    # Returns the header of the written file (True if not encrypted), or False on failure.
+    def _write_file(self, fpath, text, key1, key2, header):
+        self._flush_journal() # The edits so far are in text; the ones made from now go to the journal of the saved file
+        self.text.edit_modified(False)
+        self._on_change()
+        start = time.perf_counter()
+        try:
+            if key1:
+                future = self.pool.submit(vault.write_encrypted, fpath, text, key1, key2, header, self._cancel, self.blocks, self.search_index.get())
+            else:
+                future = self.pool.submit(vault.write_text, fpath, text)
+            results = self._wait('Saving ' + os.path.basename(fpath) + '...', future)
+            if results is None: # Cancel
+                self.text.edit_modified(True)
+                self._on_change()
+                return False
+        except vault.Cancelled:
+            pass
+        except IOError:
+            tk.messagebox.showerror(title='Encrypted Notepad', message='I/O error. Could not save the file.')
+        except ImportError: # Before InvalidToken, which is imported from cryptography on first use
+            tk.messagebox.showerror(title='Encrypted Notepad', message='Some dlls are missing. Use "--path=...bin" option in Pyinstaller to explicitly feed the dlls.')
+        except vault.FormatError as e: # e.g. zstd without the zstandard module
+            tk.messagebox.showerror(title='Encrypted Notepad', message=str(e) + ' Could not save the file.')
+        except vault.InvalidToken:
+            tk.messagebox.showerror(title='Encrypted Notepad', message='Encryption failed. Could not save the file.\nTry "Save As..." with a new password.')
+        else:
+            if key1:
+                self._start_journal(fpath, key2, results[0], snapshot=self.text.edit_modified())
+            else:
+                self._stop_journal()
+            if key1: # Report the size and time so the compression setting can be judged (see File > Compression...)
+                compression = '%s %d' % results[0].compression if results[0].compression else 'no compression'
+                self.status.misc.configure(text='Saved %s KB (%s) in %.2f s' % (format(os.path.getsize(fpath) // 1024, ','), compression, time.perf_counter() - start))
+            return results[0] or True
+        self.text.edit_modified(True)
+        self._on_change()
+        return False
 
     # Read-only password implementation
     def _on_save_file(self, event=None):
+        if self._busy:
+            return False
         if self.text.cget('state') == 'disabled':
             tk.messagebox.showinfo('Encrypted Notepad', 'This file is opened as read-only.')
             return False
@@ -592,40 +1384,18 @@ class Notepad(ttk.Frame):
         if not self.text.edit_modified(): # If not modified => Return to window
             return False
         text = self.text.get('1.0', 'end-1c')
-
-        if self.key1:
-
-            # Encode text with key2
-            try:
-                text = Fernet(self.key2).encrypt(text.encode()).decode()
-            except InvalidToken:
-                tk.messagebox.showerror(title='Encrypted Notepad', message='Encryption failed. Could not save the file.\nTry "Save As..." with a new password.')
-                return False
-
-            # Encode key2 with key1
-            # The header can be reused, but we want the header to rather change every time (Fernet is a probabilistic encryption)
-            try:
-                text += '====' + Fernet(self.key1).encrypt(self.key2).decode()
-            except InvalidToken:
-                tk.messagebox.showerror(title='Encrypted Notepad', message='Encryption failed. Could not save the file.\nTry "Save As..." with a new password.')
-                return False
-
-        try:
-            file = open(self.fpath, 'w')
-            file.write(text)
-            file.close()
-        except IOError:
-            tk.messagebox.showerror(title='Encrypted Notepad', message='I/O error. Could not save the file.')
+        header = self._write_file(self.fpath, text, self.key1, self.key2, self.header)
+        if not header:
             return False
-        else:
-            file.close()
-        self.text.edit_modified(False)
-        self._on_change()
+        if self.key1:
+            self.header = header
         return True
 
 
     # Read-only password implementation
     def _on_save_file_as(self, event=None):
+        if self._busy:
+            return False
         if self.text.cget('state') == 'disabled':
             tk.messagebox.showinfo('Encrypted Notepad', 'This file is opened as read-only.')
             return False
@@ -635,8 +1405,8 @@ class Notepad(ttk.Frame):
         fname = os.path.basename(fpath)
 
         while True:
-            # PasswordDialog returns ('master password', boolean for read-only passworod, 'read-only password') on OK and None on Cancel
-            diag = CreatePasswordDialog(self)
+            # PasswordDialog returns ('master password', boolean for read-only passworod, 'read-only password', boolean for binary) on OK and None on Cancel
+            diag = CreatePasswordDialog(self, binary=self.binary_file)
             if diag.result is not None and diag.result[1] and diag.result[2] != '' and diag.result[0] == '':
                 tk.messagebox.showinfo('Encrypted Notepad', 'You cannot set a read-only password without setting a master password.')
             elif diag.result is not None and diag.result[1] and diag.result[2] != '' and diag.result[0] == diag.result[2]:
@@ -647,57 +1417,43 @@ class Notepad(ttk.Frame):
         if diag.result is None or diag.result[0] == '': # Cancel or OK with no master password => Save without encryption
             key1 = None
             key2 = None
+            header = None
         else: # OK with password(s) => Save with encryption
-
             # Encode text with the read-only password (the read-only password can be '')
             # If no read-only password is set, use a randomly generated key
-            if diag.result[1]:
-                try:
-                    kdf = PBKDF2HMAC(algorithm=hashes.SHA256(), length=32, salt=self.salt, iterations=self.iter, backend=default_backend())
-                    key2 = base64.urlsafe_b64encode(kdf.derive(diag.result[2].encode())) # Can only use kdf once
-                except ImportError:
-                    tk.messagebox.showerror(title='Encrypted Notepad', message='Some dlls are missing. Use "--path=...bin" option in Pyinstaller to explicitly feed the dlls.')
-                    return False
-            else:
-                key2 = Fernet.generate_key()
+            # Both keys are derived in parallel with the current setting and a new salt
+            kdf = vault.new_kdf(self.kdf_setting)
             try:
-                text = Fernet(key2).encrypt(text.encode()).decode()
-            except InvalidToken:
-                tk.messagebox.showerror(title='Encrypted Notepad', message='Encryption failed. Could not save the file.')
-                return False
+                deriving = [self.pool.submit(self.key_cache.derive, diag.result[0], self.salt, kdf)]
+                if diag.result[1]:
+                    deriving.append(self.pool.submit(self.key_cache.derive, diag.result[2], self.salt, kdf))
+                results = self._wait('Generating keys...', *deriving)
+                if results is None: # Cancel
+                    return False
             except ImportError:
                 tk.messagebox.showerror(title='Encrypted Notepad', message='Some dlls are missing. Use "--path=...bin" option in Pyinstaller to explicitly feed the dlls.')
                 return False
+            key1 = results[0]
+            key2 = results[1] if diag.result[1] else vault.random_key()
+            header = vault.new_header(kdf, readonly=diag.result[1], binary=diag.result[3], compression=self.compression_setting)
+            self.binary_file = diag.result[3]
 
-            # Encode key2 with the master password
-            kdf = PBKDF2HMAC(algorithm=hashes.SHA256(), length=32, salt=self.salt, iterations=self.iter, backend=default_backend())
-            key1 = base64.urlsafe_b64encode(kdf.derive(diag.result[0].encode())) # Can only use kdf once
-            try:
-                text += '====' + Fernet(key1).encrypt(key2).decode()
-            except InvalidToken:
-                tk.messagebox.showerror(title='Encrypted Notepad', message='Encryption failed. Could not save the file.')
-                return False
-
-        try:
-            file = open(fpath, mode='w')
-            file.write(text)
-            file.close()
-        except IOError:
-            tk.messagebox.showerror(title='Encrypted Notepad', message='I/O error. Could not save the file.')
+        header = self._write_file(fpath, text, key1, key2, header)
+        if not header:
             return False
-        else:
-            file.close()
         self.fpath = fpath
         self.fname = fname
         self.key1 = key1
         self.key2 = key2
-        self.text.edit_modified(False)
+        self.header = header if key1 else None
         self._on_change()
         self._update_recent_files(fpath)
         return True
 
 
     def _on_exit(self, event=None):
+        if self._busy:
+            return
         if self.text.edit_modified():
             ans = tk.messagebox.askyesnocancel('Encrypted Notepad', 'Do you want to save changes to ' + self.fname + '?')
             if ans: # Yes
@@ -705,60 +1461,91 @@ class Notepad(ttk.Frame):
                     return
             elif ans is None: # Cancel
                 return
-        if root.state() == 'normal':
+        self._stop_journal()
+        window = self.winfo_toplevel()
+        if window.state() == 'normal':
             self.cp.set('settings', 'fullscreen', str(False))
-            self.cp.set('settings', 'window', root.geometry())
-        elif root.state() == 'zoomed':
+            self.cp.set('settings', 'window', window.geometry())
+        elif window.state() == 'zoomed':
             self.cp.set('settings', 'fullscreen', str(True))
-        self.cp.set('settings', 'ignore_case', str(self.fr.ignorecase.get()))
-        self.cp.set('settings', 'whole_word', str(self.fr.wholeword.get()))
-        self.cp.set('settings', 'within_selection', str(self.fr.withinsel.get()))
-        self.cp.set('settings', 'regular_expression', str(self.fr.regexp.get()))
+        if self._fr is not None: # Otherwise the settings have not changed
+            self.cp.set('settings', 'ignore_case', str(self.fr.ignorecase.get()))
+            self.cp.set('settings', 'whole_word', str(self.fr.wholeword.get()))
+            self.cp.set('settings', 'within_selection', str(self.fr.withinsel.get()))
+            self.cp.set('settings', 'regular_expression', str(self.fr.regexp.get()))
+        self.cp.set('settings', 'binary_file', str(self.binary_file))
         self.cp.write2()
-        root.quit()
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None # A hidden main window may be used again (see open_window)
+        if self._search_pool is not None:
+            self._search_pool.shutdown(wait=False, cancel_futures=True)
+            self._search_pool = None
+        notes.remove(self)
+        if not notes:
+            root.quit()
+        elif window is root: # Other windows are open, which go with root => Hide it until open_window needs it again
+            root.withdraw()
+        else:
+            window.destroy()
 
     def _on_undo(self, event=None):
         try:
             self.text.edit_undo()
-            self.text.event_generate('<ButtonRelease-1>')
         except:
             pass
 
     def _on_redo(self, event=None):
         try:
             self.text.edit_redo()
-            self.text.event_generate('<ButtonRelease-1>')
         except:
             pass
 
-    # The event <<Cut>> itself does not trigger <<KeyRelease>>, so the status bar is not updated.
-    # On the other hand, triggering <Control-x> generates key strokes that the user did not press.
-    # So generate both <<Cut>> and <ButtonRelease-1> to solve these issues.
+    # The status bar follows the changes these make by itself (see _on_text_command)
     def _on_cut(self, event=None):
         self.text.event_generate('<<Cut>>')
-        self.text.event_generate('<ButtonRelease-1>')
 
     def _on_copy(self, event=None):
         self.text.event_generate('<<Copy>>')
-        self.text.event_generate('<ButtonRelease-1>')
 
     def _on_paste(self, event=None):
         self.text.event_generate('<<Paste>>')
-        self.text.event_generate('<ButtonRelease-1>')
 
     def _on_delete(self, event=None):
         self.text.event_generate('<<Clear>>')
-        self.text.event_generate('<ButtonRelease-1>')
 
     def _on_select_all(self, event=None):
         self.text.event_generate('<<SelectAll>>')
-        self.text.event_generate('<ButtonRelease-1>')
 
     #def _on_rect_select(self, event=None):
     #    pass
 
+    # Worker threads for file I/O, key derivation, en/decryption, created when they are first needed
+    @property
+    def pool(self):
+        if self._pool is None:
+            self._pool = concurrent_futures.ThreadPoolExecutor(max_workers=2)
+        return self._pool
+
+    # Worker threads for searches and counts, apart from pool: a regex cannot be stopped until search_timeout, and the
+    # Cancel button only stops waiting for it, so a search left running must not hold up opening or saving a file
+    @property
+    def search_pool(self):
+        if self._search_pool is None:
+            self._search_pool = concurrent_futures.ThreadPoolExecutor(max_workers=2)
+        return self._search_pool
+
+    # The Find/Replace window, created (hidden) when it is first needed rather than before the main window is shown
+    @property
+    def fr(self):
+        if self._fr is None:
+            self._fr = self.FindReplace(self, **self._fr_settings)
+            self._fr.withdraw()
+        return self._fr
+
     def _on_find_replace(self, event=None):
         self.fr.deiconify()
+        self.fr._on_pattern_change() # The text may have changed while it was hidden
         self.fr.entry_find.icursor('end') # Set the cursor to the end
         #self.fr.entry_find.focus_set()
         self.fr.entry_find.selection_range(0, 'end') # Select all. This automatically sets focus
@@ -769,6 +1556,29 @@ class Notepad(ttk.Frame):
     def _on_find_previous(self, event=None):
         self.fr.find_previous()
 
+    def _on_search_files(self, event=None):
+        diag = SearchFilesDialog(self, os.path.dirname(self.fpath) if self.fpath else os.getcwd(),
+            ignorecase=self._fr_settings['ignorecase'] if self._fr is None else self._fr.ignorecase.get(),
+            regexp=self._fr_settings['regexp'] if self._fr is None else self._fr.regexp.get())
+        if diag.result is None:
+            return
+        folder, pattern, ignorecase, regexp, pwd = diag.result
+        try:
+            p = re.compile(pattern if regexp else re.escape(pattern), re.IGNORECASE if ignorecase else 0)
+        except re.error:
+            tk.messagebox.showerror(title='Encrypted Notepad', message='Pattern syntax error.')
+            return
+        if folder:
+            try:
+                files = sorted(os.path.join(folder, f) for f in os.listdir(folder) if not f.endswith((vault.JOURNAL_SUFFIX, vault.INDEX_SUFFIX)))
+            except OSError as e:
+                tk.messagebox.showerror(title='Encrypted Notepad', message=str(e))
+                return
+            files = [f for f in files if os.path.isfile(f)]
+        else:
+            files = [f for f in self.recent_files if os.path.isfile(f)]
+        self.SearchResults(self, files, p, pwd, vault.pattern_trigrams(pattern, regexp))
+
     def _on_time_date(self, event=None):
         now = datetime.now().strftime('%I:%M %p %m/%d/%Y')
         if self.text.tag_ranges('sel'):
@@ -782,7 +1592,6 @@ class Notepad(ttk.Frame):
             self.text.insert('insert', now) # insert
         self.text.tag_add('sel', start, 'insert') # select inserted string
         self.text.edit_separator()
-        self.text.event_generate('<ButtonRelease-1>')
 
     def _on_random_string(self, event=None):
         chars = string.ascii_letters + string.punctuation + string.digits # candidate letters
@@ -798,7 +1607,6 @@ class Notepad(ttk.Frame):
             self.text.insert('insert', pwd) # insert
         self.text.tag_add('sel', start, 'insert') # select inserted string
         self.text.edit_separator()
-        self.text.event_generate('<ButtonRelease-1>')
 
     def _on_word_wrap(self, event=None):
         if self.wrap_type.get() == 0: # None
@@ -1097,6 +1905,7 @@ class Notepad(ttk.Frame):
 
             self.strfind_list = []
             self.strreplace_list = []
+            self.patterns = PatternCache()
 
             self.frame_entry = ttk.Frame(self)
             self.frame_buttons = ttk.Frame(self)
@@ -1107,6 +1916,8 @@ class Notepad(ttk.Frame):
             ttk.Label(self.frame_entry, text='Search for:', anchor='w').grid(row=0, column=0, sticky='w')
             self.entry_find = ttk.Combobox(self.frame_entry, textvariable=self.strfind)
             self.entry_find.grid(row=1, column=0, columnspan=2, sticky='ew', pady=(0,20))
+            self.label_count = ttk.Label(self.frame_entry, text='', anchor='e') # see _on_pattern_change
+            self.label_count.grid(row=0, column=1, sticky='e')
 
             ttk.Label(self.frame_entry, text='Replace with:', anchor='w').grid(row=2, column=0, sticky='w')
             self.entry_repl = ttk.Combobox(self.frame_entry, textvariable=self.strreplace)
@@ -1156,12 +1967,147 @@ class Notepad(ttk.Frame):
             self.bind('<F3>', self.find_next)
             self.bind('<Shift-F3>', self.find_previous)
 
+            self._count_job = None       # pending _start_count
+            self._count_generation = 0   # incremented by every change, which tells a running count that it is stale
+            self._places = None          # (mirror version, ignore case, plain pattern, its places) of the last count
+            for var in (self.strfind, self.ignorecase, self.wholeword, self.withinsel, self.regexp):
+                var.trace_add('write', self._on_pattern_change)
+            self.master._edit_listeners.append(lambda edits: self._on_pattern_change(delay=1000))
+            self.master.text.bind('<<Selection>>', lambda e: self.withinsel.get() and self._on_pattern_change(), add='+')
+
             self.iconbitmap(resource_path('security.ico'))
             self.wm_geometry("450x270")
             self.entry_find.focus_set()
 
             # Make the entry boxes a Combobox and store search/replace history
 
+        # Live count of the matches in the text (or the selection, with Within Selection), next to the pattern. It runs in a
+        # worker 0.2 seconds after the last change of the pattern or the options (1 second after the last edit of the text),
+        # on the mirror of the text as it is then, and gives up as soon as there is a newer change: the text is scanned
+        # COUNT_SLICE characters at a time (see _count). For a plain pattern, the places where it occurs (overlapping) are
+        # kept, so that typing more of it only checks those places rather than the whole text.
+        COUNT_SLICE = 1 << 16
+
+        def _on_pattern_change(self, *args, delay=200):
+            self._count_generation += 1
+            if self._count_job is not None:
+                self.after_cancel(self._count_job)
+                self._count_job = None
+            if self.state() != 'withdrawn':
+                self._count_job = self.after(delay, self._start_count)
+
+        def _start_count(self):
+            self._count_job = None
+            pattern = self.strfind.get()
+            if pattern == '':
+                self.label_count.configure(text='')
+                return
+            plain = not self.regexp.get()
+            ignorecase = self.ignorecase.get()
+            try:
+                p = self.patterns.get(re.escape(pattern) if plain else pattern, ignorecase, self.wholeword.get(), False)
+                prefix = self.patterns.get(re.escape(pattern), ignorecase, False, False) if plain else None
+            except re.error:
+                self.label_count.configure(text='Pattern syntax error')
+                return
+            mirror = self.master.mirror
+            if self.withinsel.get(): # As find_all
+                if not self.master.text.tag_ranges('sel'):
+                    self.label_count.configure(text='')
+                    return
+                pos, endpos = mirror.offset(self.master.text.index('sel.first')), mirror.offset(self.master.text.index('sel.last'))
+            else:
+                pos, endpos = 0, len(mirror.text())
+            places = None
+            if plain and self._places is not None and self._places[:4] == (mirror.version, ignorecase, pos, endpos) and pattern.startswith(self._places[4]):
+                places = self._places[5]
+            generation = self._count_generation
+            stale = lambda: self._count_generation != generation
+            future = self.master.search_pool.submit(self._count, mirror.text(), pos, endpos, p, prefix, places, stale, self.master.search_timeout)
+            self._poll_count(future, generation, (mirror.version, ignorecase, pos, endpos, pattern) if plain else None)
+
+        # Return (number of matches of p in text[pos:endpos], places of prefix there), or None if stale
+        # A regular expression cannot be searched a slice at a time by cutting the text (which changes what '$', lookahead
+        # etc. see), so a slice is the COUNT_SLICE places after the last match where the next one may begin: '\G' anchors
+        # the search where finditer goes on after a match, and '\K' drops what is skipped up to the match. finditer then
+        # stops at the first gap of more than COUNT_SLICE between matches, and goes on after the gap. (This is slower than
+        # a plain finditer, which skips ahead to where a match may begin, but the count can be abandoned in between.)
+        @classmethod
+        def _count(cls, text, pos, endpos, p, prefix, places, stale, timeout):
+            if stale(): # Changed while it was waiting for a worker
+                return None
+            count = 0
+            if prefix is None: # Regular expression
+                # '\G' of its own, backwards, or inline flags (which the wrapping would move) => Not in slices
+                if p.flags & re.REVERSE or r'\G' in p.pattern or re.search(r'\(\?[a-zA-Z^-]*\)', p.pattern):
+                    for match in p.finditer(text, pos, endpos, timeout=timeout, concurrent=True):
+                        count += 1
+                        if count % 4096 == 0 and stale():
+                            return None
+                    return count, None
+                sliced = re.compile(r'\G(?s:.){0,%d}?\K(?:%s)' % (cls.COUNT_SLICE, p.pattern), p.flags)
+                while pos <= endpos:
+                    match = None
+                    for match in sliced.finditer(text, pos, endpos, timeout=timeout, concurrent=True):
+                        count += 1
+                        if count % 4096 == 0 and stale():
+                            return None
+                    pos = (pos if match is None else match.end()) + cls.COUNT_SLICE + 1
+                    if stale():
+                        return None
+                return count, None
+            if places is None:
+                # A plain pattern is matched within the text that follows its start, so it can be looked for in slices
+                # cut anywhere, as long as each goes on far enough for a match that begins in it (4 times the pattern,
+                # for case folding that makes it longer)
+                def overlapped():
+                    for start in range(pos, endpos + 1, cls.COUNT_SLICE):
+                        if stale():
+                            return
+                        end = min(start + cls.COUNT_SLICE + 4 * len(prefix.pattern), endpos)
+                        for match in prefix.finditer(text, start, end, overlapped=True, timeout=timeout, concurrent=True):
+                            if match.start() >= start + cls.COUNT_SLICE:
+                                break
+                            yield match.start()
+                matches = overlapped()
+            else: # Places of a shorter pattern that this one begins with
+                matches = (start for start in places if prefix.match(text, start, endpos, timeout=timeout))
+            found = array.array('q')
+            end = 0
+            for start in matches:
+                found.append(start)
+                if len(found) % 4096 == 0 and stale():
+                    return None
+                if start >= end: # Not overlapping the last match (which finditer would not find)
+                    match = p.match(text, start, endpos, timeout=timeout)
+                    if match:
+                        count += 1
+                        end = match.end()
+            if stale():
+                return None
+            return count, found
+
+        def _poll_count(self, future, generation, key):
+            if generation != self._count_generation:
+                return
+            if not future.done():
+                self.after(20, self._poll_count, future, generation, key)
+                return
+            try:
+                result = future.result()
+            except TimeoutError:
+                self.label_count.configure(text='Too slow to count')
+                return
+            except Exception:
+                self.label_count.configure(text='')
+                return
+            if result is None:
+                return
+            count, places = result
+            if key is not None:
+                self._places = key + (places,)
+            self.label_count.configure(text=('%d match' % count) + ('es' if count != 1 else ''))
+
         # Get the minimum tag among 'insert', 'sel.first', and 'sel.last'
         # It assumes that 'insert' is equal to one of 'sel.first' and 'sel.last', if at all
         def _min_index(self):
@@ -1200,16 +2146,11 @@ class Notepad(ttk.Frame):
 
             if not self.regexp.get():
                 str = re.escape(str)
-            # https://stackoverflow.com/questions/4154961/find-substring-in-string-but-only-if-whole-words
-            # Known issue:
-            # If the text is 'wordword' and the cursor is like 'word|word' and you search for the whole word of 'word',
-            # the current algorithm catches the second (find next) or the first (find previous).
-            if self.wholeword.get():
-                str = r'\b' + str + r'\b'
-            if backwards:
-                str = '(?r)' + str
-            # https://stackoverflow.com/questions/500864/case-insensitive-regular-expression-without-re-compile
-            return str
+            try:
+                return self.patterns.get(str, self.ignorecase.get(), self.wholeword.get(), backwards)
+            except re.error:
+                tk.messagebox.showerror(title='Encrypted Notepad', message='Pattern syntax error.')
+                return None
 
         def delete_find(self, event=None):
             # https://stackoverflow.com/questions/53848622/how-to-bind-keypress-event-for-combobox-drop-out-menu-in-tkinter-python-3-7
@@ -1231,32 +2172,52 @@ class Notepad(ttk.Frame):
                 self.entry_repl.config(values=self.strreplace_list)
                 self.entry_repl.after(1, lambda: self.entry_repl.event_generate('<Button-1>'))
 
-        def _find_within(self, str, left, right):
-            left = self.master.text.index(left) # If left is specified as 'sel.first', we need to convert it to 'l.c' form.
+        # Run func(text of the mirror, timeout) in a worker, so that a pattern that backtracks without end does not freeze
+        # the window: the regex module gives up after search_timeout seconds, and the Cancel button of the status bar
+        # stops waiting for it (the worker goes on until then, apart from the workers for files, see search_pool). A search that is done within 0.1 seconds does not show the Cancel button at all.
+        # Returns [result], or None if the search failed, was cancelled, or the text was edited meanwhile.
+        def _search(self, func):
+            if self.master._busy:
+                return None
+            version = self.master.mirror.version
+            future = self.master.search_pool.submit(func, self.master.mirror.text(), self.master.search_timeout)
+            if not concurrent_futures.wait([future], timeout=0.1).done:
+                if self.master._wait('Searching...', future) is None: # Cancelled
+                    return None
             try:
-                # https://stackoverflow.com/questions/452104/is-it-worth-using-pythons-re-compile
-                if self.ignorecase.get():
-                    match = re.search(str, self.master.text.get(left, right), re.MULTILINE|re.IGNORECASE)
-                else:
-                    match = re.search(str, self.master.text.get(left, right), re.MULTILINE)
-            except re.error:
-                tk.messagebox.showerror(title='Encrypted Notepad', message='Pattern syntax error.')
+                result = future.result()
+            except TimeoutError:
+                tk.messagebox.showerror(title='Encrypted Notepad', message='The search took more than %d seconds and was stopped.' % self.master.search_timeout)
                 return None
             except RecursionError:
                 tk.messagebox.showerror(title='Encrypted Notepad', message='Too many recursion.')
                 return None
-            except:
+            except Exception:
                 tk.messagebox.showerror(title='Encrypted Notepad', message='Search failed.')
                 return None
+            if self.master.mirror.version != version: # The offsets in the result are no longer valid
+                tk.messagebox.showinfo(title='Encrypted Notepad', message='The text was changed during the search.')
+                return None
+            return [result]
+
+        # Search the mirror of the text between the indices left and right. Unlike a search of the text between them copied
+        # out, the text around them counts for '^', '\b', lookbehind etc.
+        def _find_within(self, p, left, right):
+            mirror = self.master.mirror
+            pos, endpos = mirror.offset(self.master.text.index(left)), mirror.offset(self.master.text.index(right))
+            results = self._search(lambda text, timeout: p.search(text, pos, endpos, timeout=timeout, concurrent=True))
+            if results is None:
+                return None
+            match = results[0]
             if match:
                 # Remove tags
                 self.master.text.tag_remove('sel', '1.0', 'end')
                 self.master.text.tag_remove('match', '1.0', 'end')
-                self.master.text.tag_remove('find all', '1.0', 'end')
+                self.master._clear_found()
                 self.master.status.misc.configure(text='')
                 # Set new tags
-                start_index = '%s+%dc' % (left, match.start())
-                end_index = '%s+%dc' % (left, match.end())
+                start_index = mirror.index(match.start())
+                end_index = mirror.index(match.end())
                 self.master.text.tag_add('match', start_index, end_index)
                 self.master.text.tag_add('sel', start_index, end_index)
                 self.master.text.mark_set('insert', end_index)
@@ -1268,8 +2229,8 @@ class Notepad(ttk.Frame):
                 return False
 
         def find_next(self, event=None):
-            str = self._get_pattern(backwards=False)
-            if str is None:
+            p = self._get_pattern(backwards=False)
+            if p is None:
                 return
             if self.withinsel.get():
                 if not self.master.text.tag_ranges('sel'):
@@ -1295,17 +2256,17 @@ class Notepad(ttk.Frame):
             #if not self._find_within(str2, left, right) and not self.withinsel.get():
             #    self._find_within(str, '1.0', 'end-1c')
 
-            res = self._find_within(str, left, right)
+            res = self._find_within(p, left, right)
             if res is None:
                 return
             if res is False and not self.withinsel.get():
-                res = self._find_within(str, '1.0', 'end-1c')
+                res = self._find_within(p, '1.0', 'end-1c')
             if res is False:
                 tk.messagebox.showinfo(title='Encrypted Notepad', message='Not found.')
 
         def find_previous(self, event=None):
-            str = self._get_pattern(backwards=True)
-            if str is None:
+            p = self._get_pattern(backwards=True)
+            if p is None:
                 return
             if self.withinsel.get():
                 if not self.master.text.tag_ranges('sel'):
@@ -1329,60 +2290,62 @@ class Notepad(ttk.Frame):
             #if not self._find_within(str2, left, right) and not self.withinsel.get():
             #    self._find_within(str, '1.0', 'end-1c')
 
-            res = self._find_within(str, left, right)
+            res = self._find_within(p, left, right)
             if res is None:
                 return
             if res is False and not self.withinsel.get():
-                res = self._find_within(str, '1.0', 'end-1c')
+                res = self._find_within(p, '1.0', 'end-1c')
             if res is False:
                 tk.messagebox.showinfo(title='Encrypted Notepad', message='Not found.')
 
         def find_all(self):
             self.master.text.tag_remove('match', '1.0', 'end')
-            self.master.text.tag_remove('find all', '1.0', 'end')
+            self.master._clear_found()
             self.master.status.misc.configure(text='')
-            str = self._get_pattern(backwards=False)
-            if str is None:
+            p = self._get_pattern(backwards=False)
+            if p is None:
                 return
-            if self.ignorecase.get():
-                p = re.compile(str, re.MULTILINE|re.IGNORECASE)
-            else:
-                p = re.compile(str, re.MULTILINE)
             if self.withinsel.get():
                 if self.master.text.tag_ranges('sel'):
                     start = 'sel.first'
                     end = 'sel.last'
-                    left = self.master.text.index('sel.first' if self.master.text.compare('sel.first', '<', 'sel.last') else 'sel.last')
                 else:
                     return
             else:
                 start = '1.0'
                 end = 'end-1c'
-                left = '1.0'
 
             # https://stackoverflow.com/questions/250271/python-regex-how-to-get-positions-and-values-of-matches
             # https://stackoverflow.com/questions/4664850/how-to-find-all-occurrences-of-a-substring
-            count = 0
-            for match in p.finditer(self.master.text.get(start, end)):
-                self.master.text.tag_add('find all', left + '+%dc' % match.start(), left + '+%dc' % match.end())
-                count += 1
+            mirror = self.master.mirror
+            pos, endpos = mirror.offset(self.master.text.index(start)), mirror.offset(self.master.text.index(end))
+            def find(text, timeout):
+                starts = array.array('q')
+                ends = array.array('q')
+                for match in p.finditer(text, pos, endpos, timeout=timeout, concurrent=True):
+                    starts.append(match.start())
+                    ends.append(match.end())
+                return starts, ends
+            results = self._search(find)
+            if results is None:
+                return
+            starts, ends = results[0]
+            self.master._show_found(starts, ends)
+            count = len(starts)
             counttext = ('%d occurrence' % count) + ('s' if count > 1 else '') + ' found'
             self.master.status.misc.configure(text=counttext)
             tk.messagebox.showinfo(title='Encrypted Notepad', message=counttext)
 
+        # Returns False if the pattern could not be compiled (and the error has been shown)
         def _replace_fullmatch(self):
             # Remove tags
             self.master.text.tag_remove('match', '1.0', 'end')
-            self.master.text.tag_remove('find all', '1.0', 'end')
+            self.master._clear_found()
             self.master.status.misc.configure(text='')
             # Get pattern
-            str = self._get_pattern(backwards=False)
-            if str is None:
-                return
-            if self.ignorecase.get():
-                p = re.compile(str, re.MULTILINE|re.IGNORECASE)
-            else:
-                p = re.compile(str, re.MULTILINE)
+            p = self._get_pattern(backwards=False)
+            if p is None:
+                return False
 
             # Update recent replacement keywords
             str2 = self.strreplace.get()
@@ -1394,7 +2357,13 @@ class Notepad(ttk.Frame):
             self.entry_repl.config(values=self.strreplace_list)
 
             # If selection matches the pattern, replace
-            if self.master.text.tag_ranges('sel') and p.fullmatch(self.master.text.get('sel.first', 'sel.last')):
+            if not self.master.text.tag_ranges('sel'):
+                return True
+            mirror = self.master.mirror
+            pos, endpos = mirror.offset(self.master.text.index('sel.first')), mirror.offset(self.master.text.index('sel.last'))
+            results = self._search(lambda text, timeout: p.fullmatch(text[pos:endpos], timeout=timeout, concurrent=True)
+                and p.sub(str2, text[pos:endpos], timeout=timeout, concurrent=True))
+            if results is not None and results[0] is not None:
                 # Treat the whole word...
                 #if self.wholeword.get():
                 #    if self.master.text.compare('sel.first', '<', 'sel.last'):
@@ -1412,24 +2381,26 @@ class Notepad(ttk.Frame):
                 #    b = self.master.text.get(right)
                 #    if not re.fullmatch(re.escape(a)+r'\b'+re.escape(b), a+b):
                 #        return
-                rpl = p.sub(str2, self.master.text.get('sel.first', 'sel.last'))
-                self.master.text.replace('sel.first', 'sel.last', rpl)
+                self.master.text.replace('sel.first', 'sel.last', results[0])
                 self.master.text.edit_separator()
+            return True
 
 
         # If the selected text is not the 'found' text that matches the search keyword, then invoke 'find next' instead
         def replace_next(self, event=None):
-            self._replace_fullmatch()
+            if not self._replace_fullmatch():
+                return
             return self.find_next()
 
         # If the selected text is not the 'found' text that matches the search keyword, then invoke 'find previous' instead
         def replace_previous(self):
-            self._replace_fullmatch()
+            if not self._replace_fullmatch():
+                return
             return self.find_previous()
 
         def replace_all(self):
             self.master.text.tag_remove('match', '1.0', 'end')
-            self.master.text.tag_remove('find all', '1.0', 'end')
+            self.master._clear_found()
             self.master.status.misc.configure(text='')
             p = self._get_pattern(backwards=False)
             if p is None:
@@ -1438,19 +2409,48 @@ class Notepad(ttk.Frame):
                 if self.master.text.tag_ranges('sel'):
                     start = 'sel.first'
                     end = 'sel.last'
-                    left = self.master.text.index('sel.first' if self.master.text.compare('sel.first', '<', 'sel.last') else 'sel.last')
                 else:
                     return
             else:
                 start = '1.0'
                 end = 'end-1c'
 
-            text, count = p.subn(self.strreplace.get(), self.master.text.get(start, end))
-            self.master.text.replace(start, end, text)
+            # Only the matches whose replacement differs are replaced, each by itself, so that marks, tags and the view
+            # elsewhere stay where they are, and the undo stack holds the replaced pieces rather than the whole text
+            mirror = self.master.mirror
+            pos, endpos = mirror.offset(self.master.text.index(start)), mirror.offset(self.master.text.index(end))
+            repl = self.strreplace.get()
+            def replace(text, timeout):
+                edits = []
+                count = 0
+                for match in p.finditer(text, pos, endpos, timeout=timeout, concurrent=True):
+                    count += 1
+                    new = match.expand(repl)
+                    if new != match.group():
+                        edits.append((match.start(), match.end(), new))
+                return edits, count
+            results = self._search(replace)
+            if results is None:
+                return
+            edits, count = results[0]
+            # Indices are taken before anything is replaced, and the replacements are done from the last one, so that
+            # each replacement leaves the indices of those before it as they are
+            edits = [(mirror.index(offset1), mirror.index(offset2), new) for offset1, offset2, new in edits]
+            left = mirror.index(pos)
+            self.master.text.mark_set('replace.last', mirror.index(endpos))
+            self.master.text.mark_gravity('replace.last', 'right')
+            self.master.text.edit_separator()
+            self.master.text.configure(autoseparators=False) # All in one undo
+            try:
+                for index1, index2, new in reversed(edits):
+                    self.master.text.replace(index1, index2, new)
+            finally:
+                self.master.text.configure(autoseparators=True)
             self.master.text.edit_separator()
             if self.withinsel.get():
-                self.master.text.tag_add('match', left, 'insert')
-                self.master.text.tag_add('sel', left, 'insert')
+                self.master.text.tag_add('match', left, 'replace.last')
+                self.master.text.tag_add('sel', left, 'replace.last')
+            self.master.text.mark_unset('replace.last')
             counttext = ('%d occurrence' % count) + ('s' if count > 1 else '') + ' replaced'
             self.master.status.misc.configure(text=counttext)
             tk.messagebox.showinfo(title='Encrypted Notepad', message=counttext)
@@ -1465,10 +2465,316 @@ class Notepad(ttk.Frame):
         def close(self, event=None):
             # clear tags
             self.master.text.tag_remove('match', '1.0', 'end')
-            self.master.text.tag_remove('find all', '1.0', 'end')
+            self.master._clear_found()
             self.master.status.misc.configure(text='')
             self.withdraw()
 
+    # Results of Search in Files, listed as the files are searched. Each file is decrypted and searched by
+    # vault.search_file in a pool of worker processes, so that a folder of files uses all the cores for the key
+    # derivation and the search. A search of a file stops after search_timeout seconds, and Stop (or closing the window)
+    # terminates the workers. The keys derived there go to the key cache, so that searching again (or opening a file
+    # found) does not derive them again. A file whose search index rules out the trigrams of the pattern is not decrypted.
+    # Double-click a result to open the file at the line.
+    class SearchResults(tk.Toplevel):
+        def __init__(self, parent, files, pattern, pwd, trigrams):
+            tk.Toplevel.__init__(self, master=parent)
+            self.title('Search in Files')
+            self.pwd = pwd
+            self.status = tk.StringVar()
+
+            frame = ttk.Frame(self)
+            self.tree = ttk.Treeview(frame, columns=('line', 'text'), selectmode='browse')
+            self.tree.heading('#0', text='File', anchor='w')
+            self.tree.heading('line', text='Line', anchor='w')
+            self.tree.heading('text', text='Text', anchor='w')
+            self.tree.column('#0', width=150, stretch=False)
+            self.tree.column('line', width=50, stretch=False)
+            vscroll = ttk.Scrollbar(frame, orient='vertical', command=self.tree.yview)
+            self.tree.configure(yscrollcommand=vscroll.set)
+            self.tree.grid(row=0, column=0, sticky='nsew')
+            vscroll.grid(row=0, column=1, sticky='ns')
+            frame.grid_columnconfigure(0, weight=1)
+            frame.grid_rowconfigure(0, weight=1)
+            frame.pack(fill='both', expand=True, padx=10, pady=(10,0))
+            frame = ttk.Frame(self)
+            ttk.Label(frame, textvariable=self.status, anchor='w').pack(side='left', fill='x', expand=True)
+            self.button = ttk.Button(frame, text='Stop', command=self.stop)
+            self.button.pack(side='right')
+            frame.pack(fill='x', padx=10, pady=10)
+
+            self.tree.bind('<Double-1>', self.open)
+            self.tree.bind('<Return>', self.open)
+            self.bind('<Escape>', self.close)
+            self.protocol('WM_DELETE_WINDOW', self.close)
+            self.iconbitmap(resource_path('security.ico'))
+            self.wm_geometry('600x400')
+
+            self.locations = {} # item of the tree -> (file, line)
+            self.total = len(files)
+            self.searched = 0
+            self.hits = 0
+            self.skipped = 0 # files ruled out by their index
+            self.searches = [] # (file, header, multiprocessing AsyncResult) of the files being searched
+            self.workers = multiprocessing.get_context('spawn').Pool() # Unlike ProcessPoolExecutor, it can be terminated
+            for fpath in files:
+                try:
+                    header = vault.sniff(fpath, parent.iter)
+                except (OSError, vault.FormatError) as e:
+                    self._add(fpath, '', '(%s)' % e)
+                    self.searched += 1
+                    continue
+                key = parent.key_cache.get(pwd, parent.salt, header.kdf) if header is not None else None
+                self.searches.append((fpath, header, self.workers.apply_async(vault.search_file,
+                    (fpath, pattern, pwd, key, parent.salt, parent.iter, trigrams, 1000, parent.search_timeout))))
+            self.poll()
+
+        def _add(self, fpath, line, text):
+            item = self.tree.insert('', 'end', text=os.path.basename(fpath), values=(line, text[:500]))
+            self.locations[item] = (fpath, line)
+
+        def poll(self):
+            if not self.winfo_exists():
+                return
+            searches = []
+            for fpath, header, future in self.searches:
+                if not future.ready():
+                    searches.append((fpath, header, future))
+                    continue
+                self.searched += 1
+                try:
+                    hits, key, skipped = future.get()
+                except TimeoutError:
+                    self._add(fpath, '', '(The search took more than %d seconds and was stopped)' % self.master.search_timeout)
+                    continue
+                except vault.DecryptionError:
+                    self._add(fpath, '', '(Wrong password)')
+                    continue
+                except Exception as e:
+                    self._add(fpath, '', '(%s)' % (str(e) or type(e).__name__))
+                    continue
+                if key is not None:
+                    self.master.key_cache.put(self.pwd, self.master.salt, header.kdf, key)
+                for number, line in hits:
+                    self._add(fpath, number, line)
+                self.hits += len(hits)
+                self.skipped += skipped
+            self.searches = searches
+            self.status.set('%d of %d files searched (%d ruled out by their index), %d line%s found' % (self.searched, self.total, self.skipped, self.hits, '' if self.hits == 1 else 's'))
+            if searches:
+                self.after(100, self.poll)
+            else:
+                self.workers.close()
+                self.button.configure(text='Close', command=self.close)
+
+        # The files being searched are not searched to the end, and the rest not at all
+        def stop(self, event=None):
+            self.workers.terminate()
+            self.searches = []
+
+        def close(self, event=None):
+            self.stop()
+            self.destroy()
+
+        def open(self, event=None):
+            location = self.locations.get(self.tree.focus())
+            if location is None:
+                return
+            fpath, line = location
+            note = self.master
+            if note.fpath != fpath:
+                note._on_open_file(fpath=fpath)
+            if note.fpath == fpath and line != '':
+                note.text.tag_remove('sel', '1.0', 'end')
+                note.text.tag_add('sel', '%d.0' % line, '%d.end' % line)
+                note.text.mark_set('insert', '%d.0' % line)
+                note.text.see('insert')
+                note.winfo_toplevel().lift()
+                note.text.focus_set()
+
+    # Read-only view of a plain text file too large for the editor (see MappedText). Only the lines on the screen are put
+    # into the Text widget, and they are replaced as it scrolls; the scrollbar is by bytes, so it works before the lines
+    # are counted. Find searches the file in a worker of the pool, which the Cancel button of the status bar stops.
+    class LargeFileViewer(tk.Toplevel):
+        def __init__(self, parent, fpath):
+            self.file = MappedText(fpath, locale.getpreferredencoding(False)) # The encoding open() reads plain text with
+            tk.Toplevel.__init__(self, master=parent)
+            self.title(os.path.basename(fpath) + ' - Large File Viewer')
+            self.pattern = tk.StringVar()
+            self.ignorecase = tk.BooleanVar(value=parent._fr_settings['ignorecase'] if parent._fr is None else parent._fr.ignorecase.get())
+            self.regexp = tk.BooleanVar(value=parent._fr_settings['regexp'] if parent._fr is None else parent._fr.regexp.get())
+            self.status = tk.StringVar()
+
+            frame = ttk.Frame(self)
+            ttk.Label(frame, text='Find:').pack(side='left')
+            entry = ttk.Entry(frame, textvariable=self.pattern)
+            entry.pack(side='left', fill='x', expand=True, padx=5)
+            ttk.Button(frame, text='Previous', command=lambda: self.find(backwards=True)).pack(side='left')
+            ttk.Button(frame, text='Next', command=self.find).pack(side='left')
+            ttk.Checkbutton(frame, text='Ignore Case', variable=self.ignorecase).pack(side='left', padx=(5,0))
+            ttk.Checkbutton(frame, text='Regular Expression', variable=self.regexp).pack(side='left', padx=(5,0))
+            frame.pack(fill='x', padx=10, pady=10)
+            frame = ttk.Frame(self)
+            self.text = tk.Text(frame, wrap='none', font=parent.text.cget('font'), foreground=parent.text.cget('foreground'),
+                background=parent.text.cget('background'), insertbackground=parent.text.cget('insertbackground'))
+            self.text.tag_configure('match', foreground=self.text.tag_cget('sel', 'foreground'), background=self.text.tag_cget('sel', 'background'))
+            self.vscroll = ttk.Scrollbar(frame, orient='vertical', command=self.yview)
+            hscroll = ttk.Scrollbar(frame, orient='horizontal', command=self.text.xview)
+            self.text.configure(xscrollcommand=hscroll.set)
+            self.text.grid(row=0, column=0, sticky='nsew')
+            self.vscroll.grid(row=0, column=1, sticky='ns')
+            hscroll.grid(row=1, column=0, sticky='ew')
+            frame.grid_columnconfigure(0, weight=1)
+            frame.grid_rowconfigure(0, weight=1)
+            frame.pack(fill='both', expand=True, padx=10)
+            ttk.Label(self, textvariable=self.status, anchor='w').pack(fill='x', padx=10, pady=5)
+
+            self.linespace = tk.font.Font(root=self, font=self.text.cget('font')).metrics('linespace')
+            self.top = 0       # offset of the first line shown
+            self.rows = 1      # lines that fit in the widget
+            self.match = None  # (start, end) of the last match found
+            self.searching = False
+            self.text.bind('<Configure>', self.render)
+            for key, lines in (('<Up>', -1), ('<Down>', 1), ('<Prior>', 'page-'), ('<Next>', 'page+')):
+                self.text.bind(key, lambda e, lines=lines: self.scroll(lines))
+            self.text.bind('<Control-Home>', lambda e: self.move(0))
+            self.text.bind('<Control-End>', lambda e: self.move(self.file.size))
+            self.text.bind('<MouseWheel>', lambda e: self.scroll(-3 if e.delta > 0 else 3))
+            self.text.bind('<Button-4>', lambda e: self.scroll(-3))
+            self.text.bind('<Button-5>', lambda e: self.scroll(3))
+            entry.bind('<Return>', lambda e: self.find())
+            entry.bind('<Shift-Return>', lambda e: self.find(backwards=True))
+            self.bind('<F3>', lambda e: self.find())
+            self.bind('<Shift-F3>', lambda e: self.find(backwards=True))
+            self.bind('<Escape>', self.close)
+            self.protocol('WM_DELETE_WINDOW', self.close)
+            self.iconbitmap(resource_path('security.ico'))
+            self.wm_geometry('800x600')
+
+            self.counting = threading.Thread(target=self.file.count, daemon=True)
+            self.counting.start()
+            self.poll()
+            self.text.focus_set()
+
+        # Show the lines from self.top, moved up if they do not fill the widget (at the end of the file)
+        def render(self, event=None):
+            self.rows = max(self.text.winfo_height() // self.linespace, 1)
+            lines = self.file.lines_from(self.top, self.rows)
+            while len(lines) < self.rows and self.top > 0:
+                self.top = self.file.previous_line(self.top)
+                lines.insert(0, self.file.lines_from(self.top, 1)[0])
+            self.text.configure(state='normal')
+            self.text.delete('1.0', 'end')
+            self.text.insert('1.0', '\n'.join(line for start, line in lines))
+            if self.match is not None:
+                for row, (start, line) in enumerate(lines, 1):
+                    end = start + len(line.encode(self.file.encoding, 'replace')) # not exact after a cut or an invalid byte, but within the line
+                    if start <= self.match[0] <= end:
+                        first = len(self.file.decode(start, self.match[0]))
+                        last = len(self.file.decode(start, min(self.match[1], end)))
+                        self.text.tag_add('match', '%d.%d' % (row, first), '%d.%d' % (row, max(last, first + 1)))
+                        self.text.see('%d.%d' % (row, first))
+                        break
+            self.text.configure(state='disabled')
+            bottom = self.file.next_line(lines[-1][0])
+            self.vscroll.set(self.top / max(self.file.size, 1), 1 if bottom is None else bottom / self.file.size)
+            self.show_status()
+
+        def show_status(self):
+            line = self.file.line_number(self.top)
+            if self.file.lines is not None:
+                self.status.set('Line %d of %d' % (line, self.file.lines))
+                return
+            counting = 'counting lines... %d%%' % (100 * len(self.file.newlines) * MappedText.BLOCK // max(self.file.size, 1))
+            self.status.set('Line %d (%s)' % (line, counting) if line is not None else counting.capitalize())
+
+        def poll(self):
+            if not self.winfo_exists():
+                return
+            self.show_status()
+            if self.counting.is_alive():
+                self.after(200, self.poll)
+
+        def yview(self, *args):
+            if args[0] == 'moveto':
+                self.move(int(float(args[1]) * self.file.size))
+            else:
+                self.scroll(int(args[1]) * (self.rows - 1 if args[2] == 'pages' else 1))
+
+        def move(self, offset):
+            self.top = self.file.line_start(min(max(offset, 0), self.file.size))
+            self.render()
+            return 'break'
+
+        def scroll(self, lines):
+            if lines in ('page-', 'page+'):
+                lines = (self.rows - 1) * (1 if lines == 'page+' else -1)
+            for _ in range(abs(lines)):
+                top = self.file.next_line(self.top) if lines > 0 else self.file.previous_line(self.top)
+                if top is None:
+                    break
+                self.top = top
+            self.render()
+            return 'break'
+
+        # Search from the last match, or from the top of the screen
+        def find(self, backwards=False):
+            note = self.master
+            if self.pattern.get() == '' or self.searching or note._busy:
+                return
+            try:
+                pattern = self.pattern.get().encode(self.file.encoding)
+                p = re.compile(pattern if self.regexp.get() else re.escape(pattern),
+                    re.MULTILINE | (re.IGNORECASE if self.ignorecase.get() else 0) | (re.REVERSE if backwards else 0))
+            except (re.error, UnicodeEncodeError):
+                tk.messagebox.showerror(title='Encrypted Notepad', message='Pattern syntax error.', parent=self)
+                return
+            if self.match is None:
+                offset = self.top
+            elif backwards:
+                offset = self.match[0] - (self.match[0] == self.match[1]) # An empty match is not found again
+            else:
+                offset = self.match[1] + (self.match[0] == self.match[1])
+            if offset < 0 or offset > self.file.size:
+                tk.messagebox.showinfo(title='Encrypted Notepad', message='Not found.', parent=self)
+                return
+            self.searching = True
+            try:
+                future = note.search_pool.submit(self.file.find, p, offset, backwards, note._cancel, note.search_timeout)
+                if not concurrent_futures.wait([future], timeout=0.1).done:
+                    if note._wait('Searching...', future) is None: # Cancelled
+                        return
+                match = future.result()
+            except TimeoutError:
+                tk.messagebox.showerror(title='Encrypted Notepad', message='The search took more than %d seconds and was stopped.' % note.search_timeout, parent=self)
+                return
+            except RecursionError:
+                tk.messagebox.showerror(title='Encrypted Notepad', message='Too many recursion.', parent=self)
+                return
+            except Exception:
+                tk.messagebox.showerror(title='Encrypted Notepad', message='Search failed.', parent=self)
+                return
+            finally:
+                self.searching = False
+            if match is None:
+                tk.messagebox.showinfo(title='Encrypted Notepad', message='Not found.', parent=self)
+                return
+            self.match = match
+            self.top = self.file.line_start(match[0])
+            for _ in range(self.rows // 3): # Some lines above the match
+                if self.top == 0:
+                    break
+                self.top = self.file.previous_line(self.top)
+            self.render()
+
+        # The mapping is closed only after the search and the counting are done with it
+        def close(self, event=None):
+            if self.searching:
+                return
+            self.file.stopped = True
+            self.counting.join()
+            self.file.close()
+            self.destroy()
+
 
 #pwd = tk.simpledialog.askstring(title='Password', prompt='Enter the password for ' + fname, show='*')
 
@@ -1517,11 +2823,12 @@ class EnterPasswordDialog(Dialog):
 # '=' is a padding for Base64 URL-safe encoding, so it won't repeat for 4 times.
 # So '====' can be used as a separator.
 class CreatePasswordDialog(Dialog):
-    def __init__(self, parent):
+    def __init__(self, parent, binary=False):
         # Dialog calls body() in __init__() so we need to define attributes before that
         self.pwd = tk.StringVar()
         self.read_check = tk.BooleanVar()
         self.read_pwd = tk.StringVar()
+        self.binary = tk.BooleanVar(value=binary)
         Dialog.__init__(self, parent=parent, title='Set Password')
 
     def body(self, parent):
@@ -1539,12 +2846,14 @@ class CreatePasswordDialog(Dialog):
         self.entry_read.grid(row=4, column=0, sticky='w')
         self.button_read = tk.Button(self.frame, text='***', font=smallfont, height=1, width=3, relief='groove', command=self.toggle_read, state='disabled')
         self.button_read.grid(row=4, column=1, sticky='w', padx=(10,0))
+        # Binary is about 25% smaller and faster to open, but cannot be pasted as text (e.g. into an email)
+        ttk.Checkbutton(self.frame, text='Compact binary file', variable=self.binary).grid(row=5, column=0, columnspan=3, sticky='w', pady=(10,0))
         self.iconbitmap(resource_path('security.ico'))
         self.frame.pack()
         self.entry_pwd.focus_set()
 
     def apply(self):
-        self.result = (self.pwd.get(), self.read_check.get(), self.read_pwd.get())
+        self.result = (self.pwd.get(), self.read_check.get(), self.read_pwd.get(), self.binary.get())
 
     def onscreenkeyboard(self):
         if platform.system() == 'Windows':
@@ -1584,6 +2893,204 @@ class CreatePasswordDialog(Dialog):
 
 
 
+# Key derivation setting for files encrypted from now on (files keep the parameters they were saved with)
+# Calibrate measures the selected algorithm on this machine and picks the cost that takes about the target time.
+# Returns the setting as a dictionary (see vault.kdf_to_dict) on OK and None on Cancel.
+class KeyDerivationDialog(Dialog):
+    def __init__(self, parent, setting):
+        self.kdf = vault.kdf_from_dict(setting, salt=b'')
+        self.name = tk.StringVar(value=self.kdf.name)
+        self.target = tk.StringVar(value='1.0')
+        self.cost = tk.StringVar()
+        Dialog.__init__(self, parent=parent, title='Key Derivation')
+
+    def body(self, parent):
+        self.frame = tk.Frame(self, padx=15, pady=7) # ttk.Frame does not allow padx, pady
+        ttk.Label(self.frame, text='Algorithm:', anchor='w').grid(row=0, column=0, columnspan=2, sticky='w')
+        ttk.Radiobutton(self.frame, text='PBKDF2-SHA256', value=vault.PBKDF2, variable=self.name, command=self.show_cost).grid(row=1, column=0, columnspan=2, sticky='w')
+        ttk.Radiobutton(self.frame, text='scrypt', value=vault.SCRYPT, variable=self.name, command=self.show_cost).grid(row=2, column=0, columnspan=2, sticky='w', pady=(0,10))
+        ttk.Label(self.frame, text='Target unlock time (sec):', anchor='w').grid(row=3, column=0, sticky='w')
+        ttk.Entry(self.frame, textvariable=self.target, width=6).grid(row=3, column=1, sticky='w', padx=(10,0))
+        self.button_calibrate = ttk.Button(self.frame, text='Calibrate', command=self.calibrate)
+        self.button_calibrate.grid(row=4, column=0, sticky='w', pady=10)
+        ttk.Label(self.frame, textvariable=self.cost, anchor='w').grid(row=5, column=0, columnspan=2, sticky='w')
+        self.iconbitmap(resource_path('security.ico'))
+        self.frame.pack()
+        self.show_cost()
+
+    def show_cost(self):
+        if self.kdf.name != self.name.get():
+            # Defaults until calibrated: the program's iterations and the scrypt interactive setting (n=2^14, r=8, p=1)
+            if self.name.get() == vault.SCRYPT:
+                self.kdf = vault.KDFParams(vault.SCRYPT, b'', n=2**14, r=8, p=1)
+            else:
+                self.kdf = vault.legacy_kdf(self.parent.iter)
+        if self.kdf.name == vault.SCRYPT:
+            self.cost.set('n = 2^%d, r = %d, p = %d' % (self.kdf.n.bit_length() - 1, self.kdf.r, self.kdf.p))
+        else:
+            self.cost.set('%d iterations' % self.kdf.iterations)
+
+    def calibrate(self):
+        try:
+            target = float(self.target.get())
+        except ValueError:
+            tk.messagebox.showinfo(title='Encrypted Notepad', message='Enter the target time in seconds.', parent=self)
+            return
+        self.button_calibrate.configure(state='disabled')
+        self.cost.set('Measuring...')
+        future = self.parent.pool.submit(vault.calibrate, self.name.get(), min(max(target, 0.05), 10.0))
+        def poll():
+            if not self.winfo_exists(): # Dialog closed in the meantime
+                return
+            if not future.done():
+                self.after(50, poll)
+                return
+            self.kdf = future.result()
+            self.button_calibrate.configure(state='normal')
+            self.show_cost()
+        poll()
+
+    def validate(self):
+        return self.button_calibrate.instate(['!disabled']) # Wait for the calibration to finish
+
+    def apply(self):
+        self.result = vault.kdf_to_dict(self.kdf, salt=False)
+
+
+
+
+# Compression setting for files encrypted from now on (files keep the setting they were saved with)
+# Compare measures every codec at a few levels on the current text, so the trade-off between size and time can be seen.
+# Returns (codec, level), or ('', 0) for no compression, on OK and None on Cancel.
+class CompressionDialog(Dialog):
+    def __init__(self, parent, setting):
+        self.codec = tk.StringVar(value=setting[0] if setting else '')
+        self.level = tk.StringVar(value=str(setting[1]) if setting else '')
+        self.message = tk.StringVar()
+        Dialog.__init__(self, parent=parent, title='Compression')
+
+    def body(self, parent):
+        self.frame = tk.Frame(self, padx=15, pady=7) # ttk.Frame does not allow padx, pady
+        ttk.Label(self.frame, text='Codec:', anchor='w').grid(row=0, column=0, columnspan=2, sticky='w')
+        ttk.Radiobutton(self.frame, text='None', value='', variable=self.codec, command=self.show_level).grid(row=1, column=0, columnspan=2, sticky='w')
+        for i, codec in enumerate(vault.compressors()):
+            ttk.Radiobutton(self.frame, text=codec, value=codec, variable=self.codec, command=self.show_level).grid(row=2+i, column=0, columnspan=2, sticky='w')
+        ttk.Label(self.frame, text='Level:', anchor='w').grid(row=5, column=0, sticky='w', pady=(10,0))
+        self.spin_level = ttk.Spinbox(self.frame, textvariable=self.level, width=4, state='readonly')
+        self.spin_level.grid(row=5, column=1, sticky='w', padx=(10,0), pady=(10,0))
+        self.button_compare = ttk.Button(self.frame, text='Compare', command=self.compare)
+        self.button_compare.grid(row=6, column=0, sticky='w', pady=10)
+        ttk.Label(self.frame, textvariable=self.message, anchor='w').grid(row=6, column=1, columnspan=2, sticky='w', padx=(10,0))
+        # Size and time of the current text with each setting; click a row to choose it
+        self.tree = ttk.Treeview(self.frame, columns=('size', 'time'), height=8, selectmode='browse')
+        self.tree.heading('#0', text='Setting')
+        self.tree.heading('size', text='Size (KB)')
+        self.tree.heading('time', text='Time (s)')
+        for column in ('#0', 'size', 'time'):
+            self.tree.column(column, width=90, anchor='e' if column != '#0' else 'w')
+        self.tree.bind('<<TreeviewSelect>>', self.choose)
+        self.tree.grid(row=7, column=0, columnspan=3, sticky='we')
+        self.iconbitmap(resource_path('security.ico'))
+        self.frame.pack()
+        self.show_level()
+
+    def show_level(self):
+        if self.codec.get():
+            low, default, high = vault.COMPRESSION[self.codec.get()]
+            self.spin_level.configure(from_=low, to=high, state='readonly')
+            if not self.level.get().isdigit() or not low <= int(self.level.get()) <= high:
+                self.level.set(str(default))
+        else:
+            self.level.set('')
+            self.spin_level.configure(state='disabled')
+
+    # Measure on the first 4 MB of the text, which is enough to tell the ratio and the speed
+    def compare(self):
+        text = self.parent.text.get('1.0', 'end-1c')[:4 * 1024 * 1024]
+        if text == '':
+            self.message.set('Type or open some text first.')
+            return
+        self.button_compare.configure(state='disabled')
+        self.message.set('Measuring...')
+        future = self.parent.pool.submit(vault.compression_report, text)
+        def poll():
+            if not self.winfo_exists(): # Dialog closed in the meantime
+                return
+            if not future.done():
+                self.after(50, poll)
+                return
+            self.button_compare.configure(state='normal')
+            self.message.set('')
+            self.tree.delete(*self.tree.get_children())
+            for compression, size, seconds in future.result():
+                self.tree.insert('', 'end', iid=str(compression), text='%s %d' % compression if compression else 'None',
+                    values=(format(size // 1024, ','), '%.3f' % seconds))
+        poll()
+
+    def choose(self, event=None):
+        for iid in self.tree.selection():
+            compression = ast.literal_eval(iid)
+            self.codec.set(compression[0] if compression else '')
+            self.level.set(str(compression[1]) if compression else '')
+            self.show_level()
+
+    def validate(self):
+        return self.button_compare.instate(['!disabled']) # Wait for the measurement to finish
+
+    def apply(self):
+        self.result = (self.codec.get(), int(self.level.get())) if self.codec.get() else ('', 0)
+
+
+
+
+# Search in Files: the pattern, the files to search (those in a folder, or the recent files), and the password to try on
+# the encrypted ones. Returns (folder or '' for the recent files, pattern, ignore case, regular expression, password).
+class SearchFilesDialog(Dialog):
+    def __init__(self, parent, folder, ignorecase, regexp):
+        self.pattern = tk.StringVar()
+        self.where = tk.StringVar(value='folder')
+        self.folder = tk.StringVar(value=folder)
+        self.ignorecase = tk.BooleanVar(value=ignorecase)
+        self.regexp = tk.BooleanVar(value=regexp)
+        self.pwd = tk.StringVar()
+        Dialog.__init__(self, parent=parent, title='Search in Files')
+
+    def body(self, parent):
+        self.frame = tk.Frame(self, padx=15, pady=7) # ttk.Frame does not allow padx, pady
+        ttk.Label(self.frame, text='Search for:', anchor='w').grid(row=0, column=0, columnspan=3, sticky='w')
+        self.entry_pattern = ttk.Entry(self.frame, textvariable=self.pattern, width=40)
+        self.entry_pattern.grid(row=1, column=0, columnspan=3, sticky='ew', pady=(0,10))
+        ttk.Radiobutton(self.frame, text='Files in', value='folder', variable=self.where).grid(row=2, column=0, sticky='w')
+        ttk.Entry(self.frame, textvariable=self.folder, width=30).grid(row=2, column=1, sticky='ew')
+        ttk.Button(self.frame, text='Browse...', command=self.browse).grid(row=2, column=2, sticky='w', padx=(5,0))
+        ttk.Radiobutton(self.frame, text='Recent files', value='recent', variable=self.where).grid(row=3, column=0, columnspan=3, sticky='w', pady=(0,10))
+        ttk.Checkbutton(self.frame, text='Ignore Case', variable=self.ignorecase).grid(row=4, column=0, columnspan=3, sticky='w')
+        ttk.Checkbutton(self.frame, text='Regular Expression', variable=self.regexp).grid(row=5, column=0, columnspan=3, sticky='w', pady=(0,10))
+        ttk.Label(self.frame, text='Password (for the encrypted files):', anchor='w').grid(row=6, column=0, columnspan=3, sticky='w')
+        ttk.Entry(self.frame, textvariable=self.pwd, show='*').grid(row=7, column=0, columnspan=2, sticky='w')
+        self.iconbitmap(resource_path('security.ico'))
+        self.frame.pack()
+        return self.entry_pattern
+
+    def browse(self):
+        folder = tk.filedialog.askdirectory(parent=self, initialdir=self.folder.get() or None)
+        if folder:
+            self.folder.set(folder)
+            self.where.set('folder')
+
+    def validate(self):
+        if self.pattern.get() == '':
+            tk.messagebox.showinfo(title='Encrypted Notepad', message='Enter what to search for.', parent=self)
+            return False
+        if self.where.get() == 'folder' and not os.path.isdir(self.folder.get()):
+            tk.messagebox.showinfo(title='Encrypted Notepad', message='Choose a folder.', parent=self)
+            return False
+        return True
+
+    def apply(self):
+        self.result = (self.folder.get() if self.where.get() == 'folder' else '', self.pattern.get(),
+            self.ignorecase.get(), self.regexp.get(), self.pwd.get())
+
 
 class AboutDialog(Dialog):
     def __init__(self, parent):
@@ -1663,6 +3170,8 @@ This program is a text editor with a feature to save/open a text file with Ferne
 
  - The master password and the read-only password cannot be identical. When opening the file, the program automatically distinguishes the password and opens in a corresponding mode.
 
+ - Files given on the command line (e.g. 'enotepad.exe vault.txt', which is what opening a file with the program from the file manager does) are opened at start. If the program is already running, they are opened in new windows of it instead, which takes no time to start and uses the keys it has in memory (see below). Set single_instance in enotepad.ini to False, or start with --new-instance, to run another copy.
+
  - Settings are stored in enotepad.ini in the same folder as the program. If you want to restore all default settings, delete the ini file and restart the program.
 
  - Recent files are stored under File Menu up to 5. To delete all, click Clear Recent Files. You can also delete a specific item by editing the ini file.
@@ -1671,10 +3180,18 @@ This program is a text editor with a feature to save/open a text file with Ferne
 
  - In general, a password is recommended to be long rather than complicated (https://en.wikipedia.org/wiki/Password_strength).
 
+ - A large file is shown from its first screen while the rest is still being put into the editor; until it is all in, the text is read-only and the status bar shows the progress. Cancel closes the file.
+
+ - A plain text file of 64 MiB or more can be opened in the large file viewer instead, which reads only the lines on the screen from the file (so a file of any size opens at once and takes little memory). It is read-only; Find there searches the file from the last match (Enter, F3) or back (Shift+Enter, Shift+F3), for matches of up to 4 KiB. The size is set by large_file_size in enotepad.ini (in MiB, 0 to always open files in the editor).
+
+ - Keys derived from passwords are kept in memory for 5 minutes after their last use, so reopening a file does not wait for the key derivation again. File > Lock (Ctrl+L) closes the file and forgets all of them. The duration and the number of keys are set by key_cache_ttl (0 disables it) and key_cache_size in enotepad.ini.
+
 
 [Algorithm]
 
- - Encryption key is generated by the user's password and the program's password ('salt').
+ - Encryption key is generated by the user's password, the program's password ('salt'), and a random salt of the file, with PBKDF2-SHA256 or scrypt.
+
+ - The key derivation is deliberately slow to make guessing passwords expensive. File > Key Derivation... chooses the algorithm and calibrates its cost so that unlocking a file takes about the given time on your computer. The parameters are stored in the first line of each file, so files saved with other parameters (or by older versions, without the first line) still open.
 
  - If you modify the salt in the source code, the files encrypted by that binary cannot be opened by other binaries even if they know your password (and vice versa).
 
@@ -1684,6 +3201,11 @@ This program is a text editor with a feature to save/open a text file with Ferne
 
   2. The above encryption key is encrypted with the master password and salt.
 
+ - The text is encrypted in chunks of 64 KiB with AES-256-GCM, each authenticated on its own, and the file ends with a record that authenticates the order and number of the chunks. So a large file is encrypted and decrypted a chunk at a time, and a truncated or tampered file is detected. The chunks are cut at line boundaries chosen by the text itself, so Save encrypts only the chunks around what was edited and copies the others from the file as they are; a sync client such as Dropbox then sees a change about the size of the edit instead of a whole new file.
+ - "Compact binary file" in Save As writes the same records as raw bytes instead of Base64 text, which makes the file about 25% smaller and faster to open. Leave it unchecked if you want to paste the file as text (e.g. into an email). Save keeps the format of the file.
+ - The text is compressed (zlib level 6 by default) before it is encrypted, which makes a typical file several times smaller and also faster to encrypt because fewer bytes go through the cipher. File > Compression... chooses the codec (zlib, lzma, or zstd if the zstandard module is installed) and the level for files saved with Save As; its Compare button shows the size and time of the current text with each of them. The size and time of the last save are shown in the status bar.
+ - While a file opened with the master password is edited, the edits are written (encrypted, about once a second) to a journal next to it ('<file>.journal'), so unsaved edits survive a crash. When the file is opened next time, you are asked whether to recover them. The journal is folded into the file by saving it once it grows past 64 KiB or is five minutes old, and is deleted when the file is closed normally. File > Journal Unsaved Edits turns it off.
+
 
 [Find/Replace]
 
@@ -1691,7 +3213,13 @@ This program is a text editor with a feature to save/open a text file with Ferne
 
  - 'Whole Word' functionality is implemented through the regular expression.
 
- - The cursor itself is regarded as the boundary of a word in the 'Whole Word' option. So if there is a line with 'wordword' and the cursor is in the middle (word|word), Find Next and Find Previous on 'word' will catch each side of the word.
+ - Searches see the text around the cursor (and the selection), so the cursor is not the boundary of a word in the 'Whole Word' option, and '^' matches at the cursor only if it is at the start of a line. If there is a line with 'wordword' and the cursor is in the middle (word|word), Find Next on 'word' with 'Whole Word' does not catch either side of it.
+
+ - The number of matches in the text (or in the selection, with 'Within Selection') is shown above the search box as you type.
+
+ - Searches run in the background. If one takes long (a pattern can take practically forever on some text), the Cancel button in the status bar stops waiting for it, and it is stopped after 10 seconds anyway. The limit is set by search_timeout in enotepad.ini (at least 1).
+
+ - Edit > Search in Files (Ctrl+Shift+F) searches all the files in a folder (or the recent files) with one password, several files at a time on all the cores, and lists the matching lines as they are found. Double-click a line to open the file there. Files that the password does not open, or whose search takes more than search_timeout, are listed as such; Stop ends the search at once. Files saved with File > Index for Search in Files (on by default) get a small encrypted index of the trigrams (3 letters) in them ('<file>.index'), from which Search in Files can tell that a file does not contain a word without decrypting the whole file.
 
  - Recent keywords are stored up to 5. You can delete them by pressing Delete while the keyword is selected in the dropdown list.
         ''')
@@ -1728,25 +3256,139 @@ def resource_path(relative_path):
 
     return os.path.join(base_path, relative_path)
 
+# --startup-time: report how long it took from the start of the program to the first paint of the window
+# It is shown in the status bar (and printed if there is a console).
+def report_startup(root, note, created, constructed):
+    root.update_idletasks() # Draw the window
+    shown = time.perf_counter()
+    ms = lambda t0, t1: (t1 - t0) * 1000
+    message = 'Startup %.0f ms: imports %.0f, Tk %.0f, Notepad %.0f, paint %.0f' % (ms(STARTED, shown), ms(STARTED, IMPORTED), ms(IMPORTED, created), ms(created, constructed), ms(constructed, shown))
+    note.status.misc.configure(text=message)
+    if sys.stderr is not None: # None in the --noconsole binary
+        print(message, file=sys.stderr)
+
+# Single instance (single_instance in enotepad.ini): the first launch listens on a port of localhost, which it writes
+# with a random token to INSTANCE_FILE next to enotepad.ini. A later launch hands the files on its command line over
+# to it and exits before starting Tk, and they are opened there in windows of their own, with the keys cached there.
+# The token keeps other programs from opening windows; a launch that cannot hand over becomes the first itself.
+INSTANCE_FILE = 'enotepad.instance'
+
+# Return whether the running instance took fpaths (absolute paths)
+def hand_over(instance_path, fpaths):
+    try:
+        with open(instance_path, 'r') as file:
+            port, token = file.read().split()
+        with socket.create_connection(('127.0.0.1', int(port)), timeout=2) as conn:
+            conn.sendall(('%s\n%s\n' % (token, fpaths)).encode())
+            return conn.recv(2) == b'ok'
+    except (OSError, ValueError):
+        return False
+
+# Listen for later launches in a thread, which puts the lists of files they hand over into received
+# Returns the token written to instance_path, or None if it could not listen.
+def serve_instance(instance_path, received):
+    token = secrets.token_hex(16)
+    try:
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        listener.listen()
+        with open(instance_path, 'w') as file:
+            file.write('%d %s' % (listener.getsockname()[1], token))
+    except OSError:
+        return None
+    def serve():
+        while True:
+            conn, address = listener.accept()
+            with conn:
+                try:
+                    conn.settimeout(2)
+                    reader = conn.makefile('rb')
+                    if not secrets.compare_digest(reader.readline(1024).rstrip(b'\n'), token.encode()):
+                        continue
+                    fpaths = ast.literal_eval(reader.readline(1 << 20).decode())
+                    received.put([fpath for fpath in fpaths if isinstance(fpath, str)])
+                    conn.sendall(b'ok')
+                except (OSError, ValueError, SyntaxError, TypeError, UnicodeDecodeError):
+                    pass
+    threading.Thread(target=serve, daemon=True).start()
+    return token
+
+def poll_instance(received):
+    while not received.empty():
+        fpaths = received.get()
+        for fpath in fpaths or [None]: # No files => A new window
+            open_window(fpath)
+    root.after(100, poll_instance, received)
+
+def make_window(window, key_cache=None):
+    window.iconbitmap(resource_path('security.ico'))
+    #window.iconbitmap(os.path.join(cwd, 'security.ico'))
+    window.geometry(cp.get2('settings', 'window', '400x300'))
+    window.state('zoomed' if cp.getboolean2('settings', 'fullscreen', False) else 'normal')
+    #note = Notepad(window, cp=cp, salt=os.urandom(30), iterations=100000) # Different compiled binaries become not compatible in en/decryption
+    note = Notepad(window, cp=cp, salt=vault.SALT, iterations=vault.ITERATIONS, key_cache=key_cache) # Shared with the command line (enotepad.py)
+    window.bind('<Escape>', lambda event: window.wm_state('iconic'))
+    #window.bind('<Configure>', update_geometry_tracker)
+    window.protocol('WM_DELETE_WINDOW', note._on_exit)
+    note.pack(fill='both', expand=True);
+    note.text.focus_set()
+    notes.append(note)
+    return note
+
+# Show fpath (None: an empty text) in the window that has it open, in the main window if it is empty, or in a new one
+def open_window(fpath=None):
+    target = next((n for n in notes if fpath is not None and n.fpath and os.path.normcase(os.path.abspath(n.fpath)) == os.path.normcase(fpath)), None)
+    if target is None:
+        if note not in notes: # Closed while other windows were open (see Notepad._on_exit)
+            target = note
+            target._close_file()
+            notes.append(target)
+        elif note.fpath == '' and not note.text.edit_modified() and note.text.compare('end-1c', '==', '1.0'):
+            target = note
+        else:
+            target = make_window(tk.Toplevel(root), key_cache=note.key_cache)
+        if fpath is not None:
+            target._on_open_file(fpath=fpath)
+    window = target.winfo_toplevel()
+    window.deiconify()
+    window.lift()
+    window.focus_force()
+    target.text.focus_set()
+
+
 if __name__ == '__main__':
+    if getattr(sys, 'frozen', False): # The worker processes of Search in Files run this binary too
+        multiprocessing.freeze_support()
     cwd = os.getcwd()
-    root = tk.Tk()
     cp = ConfigParser2()
     # https://stackoverflow.com/questions/11274040/os-getcwd-vs-os-path-abspathos-path-dirname-file
     cp.read(os.path.join(cwd, 'enotepad.ini'))
-    root.iconbitmap(resource_path('security.ico'))
-    #root.iconbitmap(os.path.join(cwd, 'security.ico'))
     #cp.read(r'C:\Users\User\Desktop\enotepad.ini')
+    fpaths = [os.path.abspath(arg) for arg in sys.argv[1:] if not arg.startswith('--')]
+    instance_path = os.path.join(cwd, INSTANCE_FILE)
+    single = cp.getboolean2('settings', 'single_instance', True) and '--new-instance' not in sys.argv[1:]
+    if single and hand_over(instance_path, fpaths):
+        sys.exit(0)
 
-    root.geometry(cp.get2('settings', 'window', '400x300'))
-    root.state('zoomed' if cp.getboolean2('settings', 'fullscreen', False) else 'normal')
-
-    #note = Notepad(root, cp=cp, salt=os.urandom(30), iterations=100000) # Different compiled binaries become not compatible in en/decryption
-    note = Notepad(root, cp=cp, salt=b'}\xc9\xf7\x10m\xc4g\xdb\xa7UL\xa8X\x98\x0f\xe6\xedv65\x9eRm\x00)\x1e\xeb\x08\xc9\x1f', iterations=100001)
-    root.bind('<Escape>', lambda event: root.wm_state('iconic'))
-    #root.bind('<Configure>', update_geometry_tracker)
-    root.protocol('WM_DELETE_WINDOW', note._on_exit)
-    note.pack(fill='both', expand=True);
-    note.text.focus_set()
+    root = tk.Tk()
+    created = time.perf_counter()
+    notes = [] # Notepads of the open windows
+    note = make_window(root) # The main window
+    if '--startup-time' in sys.argv[1:]:
+        root.after_idle(report_startup, root, note, created, time.perf_counter())
+    for fpath in fpaths:
+        root.after_idle(open_window, fpath)
+    token = None
+    if single:
+        received = queue.Queue()
+        token = serve_instance(instance_path, received)
+        if token is not None:
+            root.after(100, poll_instance, received)
 
     root.mainloop()
+    try:
+        with open(instance_path, 'r') as file:
+            if file.read().split()[1] == token: # Not taken over by another instance meanwhile
+                os.remove(instance_path)
+    except (OSError, IndexError):
+        pass
@@ -0,0 +1,231 @@
+"""
+Encrypted Notepad on the command line
+
+Reads and writes the files of Encrypted Notepad without the GUI (and without tkinter), so that scripts and cron jobs
+can use them:
+
+    python enotepad.py cat FILE...                    print the text
+    python enotepad.py decrypt FILE [-o OUTPUT]       write the text to OUTPUT (or standard output)
+    python enotepad.py encrypt INPUT FILE             encrypt INPUT ('-' for standard input) into FILE
+    python enotepad.py grep [-i] [-F] [-n] [-c] PATTERN FILE...
+    python enotepad.py rekey FILE                     change the passwords (and the key derivation)
+
+Passwords are asked on the terminal, or read one per line from a file descriptor with --password-fd (e.g.
+'--password-fd 3 3<secret'), in the order they would be asked. The text goes to standard output in UTF-8 as it is
+decrypted. Exit status: 0 on success, 1 if grep found nothing, 2 on error.
+
+Copyright (c) 2020 by Tetsuya Kaji
+This software is licensed by the MIT license (see Encrypted_Notepad.py).
+"""
+
+import sys
+import os
+import re
+import argparse
+import getpass
+
+import vault
+
+
+class Error(Exception):
+    pass
+
+
+# Passwords from the terminal or, with --password-fd, one per line from a file descriptor
+class Passwords:
+    def __init__(self, fd=None):
+        self.file = os.fdopen(fd, 'r', closefd=False) if fd is not None else None
+        self.last = None # Tried first for the next file, so grep over files with the same password asks only once
+
+    def ask(self, prompt, confirm=False):
+        if self.file is not None:
+            line = self.file.readline()
+            if line == '':
+                raise Error('No more passwords in the file descriptor.')
+            return line.rstrip('\r\n')
+        pwd = getpass.getpass(prompt)
+        if confirm and getpass.getpass('Retype ' + prompt[0].lower() + prompt[1:]) != pwd:
+            raise Error('The passwords do not match.')
+        return pwd
+
+
+# Return (header, pieces of text, key1, key2) of fpath, where header is None for a file that is not encrypted
+# With stream, the pieces are decrypted as they are consumed.
+def open_file(fpath, passwords, stream=True):
+    header = vault.sniff(fpath, vault.ITERATIONS)
+    if header is None:
+        return None, [vault.read_text(fpath)], None, None
+    body = vault.read_body(fpath, header)
+    pwd, asked = passwords.last, False
+    while True:
+        if pwd is None:
+            pwd, asked = passwords.ask('Password for %s: ' % fpath), True
+        key = vault.derive_key(pwd, vault.SALT, header.kdf)
+        try:
+            pieces, key1, key2, read_only = vault.unlock(fpath, header, body, pwd, key, stream=stream)
+        except vault.DecryptionError:
+            key2 = None
+        if key2 is not None: # An empty password that fails opens the file as is, which is not what we want here
+            passwords.last = pwd
+            return header, pieces, key1, key2
+        if asked:
+            raise Error('Decryption failed: ' + fpath)
+        pwd = None # The password of the last file did not work => Ask (or read the next one)
+
+
+# Write text pieces to a binary file object in UTF-8
+def write_pieces(file, pieces):
+    for piece in pieces:
+        file.write(piece.encode())
+
+
+# Key derivation and compression for a new file (or a rekeyed one)
+def kdf_from_args(args):
+    if args.kdf is None and args.target is None:
+        return vault.new_kdf(vault.kdf_to_dict(vault.legacy_kdf(vault.ITERATIONS), salt=False))
+    params = vault.calibrate(args.kdf or vault.PBKDF2, args.target or 1.0)
+    return vault.new_kdf(vault.kdf_to_dict(params, salt=False))
+
+def compression_from_args(value):
+    if value == 'none':
+        return None
+    try:
+        codec, level = value.split(':')
+        compression = vault.check_compression((codec, int(level)))
+    except (ValueError, vault.FormatError):
+        raise argparse.ArgumentTypeError('expected none or CODEC:LEVEL with CODEC one of ' + ', '.join(vault.compressors()))
+    if codec not in vault.compressors():
+        raise argparse.ArgumentTypeError(codec + ' is not available')
+    return compression
+
+# Ask the new passwords and return (key1, key2, header) for writing a file
+def new_keys(args, passwords, binary, compression):
+    master = passwords.ask('New master password: ', confirm=True)
+    if master == '':
+        raise Error('The master password cannot be empty.')
+    readonly = passwords.ask('New read-only password: ', confirm=True) if args.read_only else None
+    if readonly == master:
+        raise Error('The master password cannot be the same as the read-only password.')
+    kdf = kdf_from_args(args)
+    key1 = vault.derive_key(master, vault.SALT, kdf)
+    key2 = vault.derive_key(readonly, vault.SALT, kdf) if readonly is not None else vault.random_key()
+    return key1, key2, vault.new_header(kdf, readonly=readonly is not None, binary=binary, compression=compression)
+
+
+def cmd_cat(args, passwords):
+    for fpath in args.files:
+        write_pieces(sys.stdout.buffer, open_file(fpath, passwords)[1])
+    return 0
+
+def cmd_decrypt(args, passwords):
+    pieces = open_file(args.file, passwords)[1]
+    if args.output is None:
+        write_pieces(sys.stdout.buffer, pieces)
+    else:
+        with vault.atomic_write(args.output) as file: # Nothing is left behind if the file turns out to be damaged
+            write_pieces(file, pieces)
+    return 0
+
+def cmd_encrypt(args, passwords):
+    if args.input == '-':
+        text = sys.stdin.read()
+    else:
+        with open(args.input, 'r', encoding='utf-8') as file:
+            text = file.read()
+    key1, key2, header = new_keys(args, passwords, args.binary, args.compression)
+    vault.write_encrypted(args.file, text, key1, key2, header, index=args.index)
+    return 0
+
+def cmd_grep(args, passwords):
+    pattern = re.escape(args.pattern) if args.fixed_strings else args.pattern
+    try:
+        pattern = re.compile(pattern, re.IGNORECASE if args.ignore_case else 0)
+    except re.error as e:
+        raise Error('Invalid pattern: %s' % e)
+    found = False
+    for fpath in args.files:
+        prefix = fpath + ':' if len(args.files) > 1 else ''
+        count = 0
+        for number, line in vault.grep_pieces(pattern, open_file(fpath, passwords)[1]):
+            count += 1
+            if not args.count:
+                sys.stdout.buffer.write(('%s%s%s\n' % (prefix, '%d:' % number if args.line_number else '', line)).encode())
+        if args.count:
+            sys.stdout.buffer.write(('%s%d\n' % (prefix, count)).encode())
+        found = found or count > 0
+    return 0 if found else 1
+
+def cmd_rekey(args, passwords):
+    header, pieces, key1, key2 = open_file(args.file, passwords, stream=False)
+    if header is None:
+        raise Error(args.file + ' is not encrypted. Use encrypt.')
+    if key1 is None:
+        raise Error('Rekey needs the master password.')
+    text = ''.join(pieces)
+    del pieces
+    binary = header.binary if args.binary is None else args.binary
+    compression = args.compression if hasattr(args, 'compression') else header.compression # None: --compression none
+    index = os.path.exists(vault.index_path(args.file)) if args.index is None else args.index
+    key1, key2, header = new_keys(args, passwords, binary, compression)
+    vault.write_encrypted(args.file, text, key1, key2, header, index=index)
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='enotepad', description='Read and write Encrypted Notepad files without the GUI.')
+    parser.add_argument('--password-fd', type=int, metavar='FD', help='read passwords one per line from file descriptor FD')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    p = commands.add_parser('cat', help='print the text')
+    p.add_argument('files', nargs='+', metavar='FILE')
+    p.set_defaults(func=cmd_cat)
+
+    p = commands.add_parser('decrypt', help='write the text to a file or standard output')
+    p.add_argument('file', metavar='FILE')
+    p.add_argument('-o', '--output', help='output file (default: standard output)')
+    p.set_defaults(func=cmd_decrypt)
+
+    p = commands.add_parser('grep', help='print the lines that match a regular expression')
+    p.add_argument('pattern', metavar='PATTERN')
+    p.add_argument('files', nargs='+', metavar='FILE')
+    p.add_argument('-i', '--ignore-case', action='store_true')
+    p.add_argument('-F', '--fixed-strings', action='store_true', help='PATTERN is a plain string')
+    p.add_argument('-n', '--line-number', action='store_true')
+    p.add_argument('-c', '--count', action='store_true', help='print only the number of matching lines')
+    p.set_defaults(func=cmd_grep)
+
+    for name, func, description in (('encrypt', cmd_encrypt, 'encrypt a text file'), ('rekey', cmd_rekey, 'change the passwords')):
+        p = commands.add_parser(name, help=description)
+        if name == 'encrypt':
+            p.add_argument('input', metavar='INPUT', help="text file in UTF-8 ('-' for standard input)")
+        p.add_argument('file', metavar='FILE')
+        p.add_argument('-r', '--read-only', action='store_true', help='also set a read-only password')
+        p.add_argument('--kdf', choices=(vault.PBKDF2, vault.SCRYPT), help='key derivation (calibrated to --target)')
+        p.add_argument('--target', type=float, metavar='SECONDS', help='unlock time to calibrate the key derivation to (default: 1.0)')
+        p.add_argument('--binary', action='store_true', default=False if name == 'encrypt' else None, help='compact binary file')
+        if name == 'rekey':
+            p.add_argument('--text', action='store_false', dest='binary', help='text (Base64) file')
+        p.add_argument('--index', action='store_true', default=False if name == 'encrypt' else None, help="write the search index ('FILE.index')")
+        if name == 'rekey':
+            p.add_argument('--no-index', action='store_false', dest='index', help='remove the search index')
+        p.add_argument('--compression', type=compression_from_args, default=(vault.ZLIB, 6) if name == 'encrypt' else argparse.SUPPRESS,
+            metavar='CODEC:LEVEL', help="e.g. zlib:6, lzma:9, or none (default: %s)" % ('zlib:6' if name == 'encrypt' else 'unchanged'))
+        p.set_defaults(func=func)
+
+    args = parser.parse_args(argv)
+    try:
+        return args.func(args, Passwords(args.password_fd))
+    except (Error, vault.FormatError) as e:
+        print('enotepad: %s' % e, file=sys.stderr)
+    except (OSError, UnicodeDecodeError) as e:
+        if isinstance(e, BrokenPipeError): # e.g. piped into head
+            sys.stderr.close()
+            return 0
+        print('enotepad: %s' % e, file=sys.stderr)
+    except KeyboardInterrupt:
+        return 130
+    return 2
+
+
+if __name__ == '__main__':
+    sys.exit(main())
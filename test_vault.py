@@ -0,0 +1,96 @@
+# Tests of vault.py that need no GUI: python -m unittest test_vault
+
+import unittest
+import random
+import os
+import tempfile
+
+import regex # What Search in Files compiles the pattern with
+
+import vault
+
+
+# The trigrams that write_index puts in the index of text
+def text_trigrams(text):
+    text = text.casefold()
+    return {text[i:i+3] for i in range(len(text) - 2)}
+
+
+class PatternTrigramsTest(unittest.TestCase):
+    PATTERNS = [
+        'abc', 'abcd', 'ab.cd', 'abc+', 'abc*d', 'abc?de', 'ab{2}cde', 'a[bc]def', '[^x]abcd', 'abc$', '^abcd',
+        r'ab\.cd', r'ab\+cd', r'ab\x41cd', r'ab\101cd', r'abAcd', r'ab\N{LATIN SMALL LETTER C}d', r'\bab\Bcd',
+        r'(abc)\1', r'a(bc\x41)de', r'a(b\)c)def', 'a(bcd)?efg', 'ab|cd', '(?i)abcd', r'ab\scd', r'ab\Dcd',
+    ]
+
+    def test_plain_pattern(self):
+        self.assertEqual(vault.pattern_trigrams('aBcd', False), {'abc', 'bcd'})
+
+    def test_escape_of_a_letter_gives_up(self):
+        for pattern in (r'ab\x41cd', r'ab\101cd', r'ab\u0041cd', r'a(b\x41c)de'):
+            self.assertEqual(vault.pattern_trigrams(pattern, True), set(), pattern)
+
+    # The index must never rule out a text that the pattern matches
+    def test_matching_text_has_the_trigrams(self):
+        rng = random.Random(0)
+        for pattern in self.PATTERNS:
+            trigrams = vault.pattern_trigrams(pattern, True)
+            for flags in (0, regex.IGNORECASE):
+                p = regex.compile(pattern, flags)
+                texts = ['abcde', 'abAcd', 'ab.cd', 'ab+cd', 'abccd', 'abcbcde', 'xabcd', 'abbcde', 'a)defg', 'ABCD', 'ab cd']
+                texts += [''.join(rng.choice('abcdeAB.+ )x') for _ in range(rng.randint(0, 12))) for _ in range(300)]
+                for text in texts:
+                    if p.search(text):
+                        self.assertLessEqual(trigrams, text_trigrams(text), (pattern, flags, text))
+
+
+class SearchIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.fpath = os.path.join(self.dir.name, 'notes.txt')
+        self.salt = b'salt_'
+        self.header = vault.new_header(vault.new_kdf({'name': vault.PBKDF2, 'iterations': 1000}), False)
+        self.key1 = vault.derive_key('pwd', self.salt, self.header.kdf)
+        self.key2 = vault.random_key()
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def search(self, word):
+        return vault.search_file(self.fpath, regex.compile(word), 'pwd', None, self.salt, 1000, vault.pattern_trigrams(word, False))
+
+    def test_round_trip(self):
+        header1 = vault.write_encrypted(self.fpath, 'The quick brown fox\njumps over the lazy dog\n', self.key1, self.key2, self.header, index=True)
+        bitmap = vault.read_index(self.fpath, self.key2, header1)
+        self.assertTrue(vault.index_may_contain(bitmap, vault.pattern_trigrams('LAZY dog', False)))
+        self.assertFalse(vault.index_may_contain(bitmap, vault.pattern_trigrams('cat', False)))
+        vault.write_encrypted(self.fpath + '.2', 'cat\n', self.key1, self.key2, header1, index=True)
+        os.replace(vault.index_path(self.fpath + '.2'), vault.index_path(self.fpath))
+        self.assertIsNone(vault.read_index(self.fpath, self.key2, header1)) # Not from the save it was written with
+
+    def test_search_in_files(self):
+        vault.write_encrypted(self.fpath, 'The quick brown fox\njumps over the lazy dog\n', self.key1, self.key2, self.header, index=True)
+        self.assertEqual(self.search('lazy'), ([(2, 'jumps over the lazy dog')], self.key1, False))
+        self.assertEqual(self.search('zebra'), ([], self.key1, True))
+
+    def test_turned_off(self):
+        header = vault.write_encrypted(self.fpath, 'zebra\n', self.key1, self.key2, self.header, index=True)
+        self.assertTrue(os.path.exists(vault.index_path(self.fpath)))
+        vault.write_encrypted(self.fpath, 'zebra\n', self.key1, self.key2, header, index=False)
+        self.assertFalse(os.path.exists(vault.index_path(self.fpath)))
+        self.assertEqual(self.search('zebra'), ([(1, 'zebra')], self.key1, False))
+
+    # A save that copies blocks adds the trigrams of the new ones to the index of the file
+    def test_updated(self):
+        rng = random.Random(0)
+        lines = [''.join(rng.choice('abcdefgh ') for _ in range(60)) for _ in range(5000)]
+        blocks = vault.BlockMap()
+        header = vault.write_encrypted(self.fpath, '\n'.join(lines), self.key1, self.key2, self.header, blocks=blocks, index=True)
+        lines[2500] = 'zebra'
+        vault.write_encrypted(self.fpath, '\n'.join(lines), self.key1, self.key2, header, blocks=blocks, index=True)
+        self.assertEqual(self.search('zebra'), ([(2501, 'zebra')], self.key1, False))
+        self.assertEqual(self.search('yak'), ([], self.key1, True))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,1129 @@
+"""
+Key derivation and file format helpers for Encrypted Notepad
+
+Copyright (c) 2020 by Tetsuya Kaji
+
+This software is licensed by the MIT license. See Encrypted_Notepad.py or LICENSE for the full text.
+"""
+
+# Nothing in this module may import tkinter. Everything here is plain data in, plain data out, so that it can be
+# reused by anything that needs to read or write the encrypted files.
+
+import os
+import time
+import hmac
+import hashlib
+import re
+import binascii
+import json
+import codecs
+import threading
+import queue
+import itertools
+import importlib.util
+import zlib
+import lzma
+from collections import OrderedDict, namedtuple
+import contextlib
+from contextlib import contextmanager
+
+import base64
+
+# cryptography takes longer to import than the rest of the program together, and nothing before the first open/save
+# needs it, so it is imported by the functions that use it (through _import_crypto()). Other modules can still use
+# vault.Fernet etc. (see __getattr__()).
+_CRYPTO_NAMES = ('default_backend', 'hashes', 'PBKDF2HMAC', 'Scrypt', 'HKDF', 'AESGCM', 'InvalidTag', 'Fernet', 'InvalidToken')
+
+def _import_crypto():
+    global default_backend, hashes, PBKDF2HMAC, Scrypt, HKDF, AESGCM, InvalidTag, Fernet, InvalidToken
+    if 'InvalidToken' in globals():
+        return
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+    from cryptography.hazmat.primitives.kdf.scrypt import Scrypt
+    from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+    from cryptography.exceptions import InvalidTag
+    from cryptography.fernet import Fernet, InvalidToken
+
+def __getattr__(name):
+    if name in _CRYPTO_NAMES:
+        _import_crypto()
+        return globals()[name]
+    raise AttributeError("module 'vault' has no attribute '%s'" % name)
+
+
+class FormatError(Exception):
+    pass
+
+# Raised in a worker when the user pressed Cancel
+class Cancelled(Exception):
+    pass
+
+
+# Key derivation parameters of a file
+#  - name: PBKDF2 ('pbkdf2-sha256', uses iterations) or SCRYPT ('scrypt', uses n, r, and p)
+#  - salt: random bytes of the file; the actual salt is the program's salt followed by this, so that the program's salt
+#    keeps working as a 'program password' while two files never share a key. Files without a header use b''.
+PBKDF2 = 'pbkdf2-sha256'
+SCRYPT = 'scrypt'
+KDFParams = namedtuple('KDFParams', ['name', 'salt', 'iterations', 'n', 'r', 'p'], defaults=[b'', 0, 0, 0, 0])
+
+# The program's salt and the PBKDF2 iterations of files without the header
+# A build with a different salt cannot open the files of this one (the salt works as a 'program password').
+SALT = b'}\xc9\xf7\x10m\xc4g\xdb\xa7UL\xa8X\x98\x0f\xe6\xedv65\x9eRm\x00)\x1e\xeb\x08\xc9\x1f'
+ITERATIONS = 100001
+
+# Anything beyond these is more likely a corrupted (or malicious) header than a real setting
+MAX_ITERATIONS = 100000000
+MAX_SCRYPT_N = 2**22
+
+def kdf_to_dict(params, salt=True):
+    if params.name == SCRYPT:
+        d = {'name': SCRYPT, 'n': params.n, 'r': params.r, 'p': params.p}
+    else:
+        d = {'name': PBKDF2, 'iterations': params.iterations}
+    if salt:
+        d['salt'] = base64.urlsafe_b64encode(params.salt).decode()
+    return d
+
+def kdf_from_dict(d, salt=None):
+    try:
+        if salt is None:
+            salt = base64.urlsafe_b64decode(d.get('salt', ''))
+        if d['name'] == SCRYPT:
+            n, r, p = int(d['n']), int(d['r']), int(d['p'])
+            if n < 2 or n > MAX_SCRYPT_N or n & (n - 1) or not 0 < r <= 32 or not 0 < p <= 16:
+                raise FormatError('Invalid scrypt parameters.')
+            return KDFParams(SCRYPT, salt, n=n, r=r, p=p)
+        if d['name'] == PBKDF2:
+            iterations = int(d['iterations'])
+            if not 0 < iterations <= MAX_ITERATIONS:
+                raise FormatError('Invalid PBKDF2 parameters.')
+            return KDFParams(PBKDF2, salt, iterations=iterations)
+    except (KeyError, TypeError, ValueError, binascii.Error):
+        raise FormatError('Invalid key derivation parameters.')
+    raise FormatError('Unsupported key derivation: %s' % d['name'])
+
+# Parameters for a new file: the given setting with a fresh salt
+def new_kdf(d):
+    return kdf_from_dict(d, salt=os.urandom(16))
+
+
+# Derive a Fernet key (URL-safe Base64 of 32 bytes) from the password
+def derive_key(pwd, salt, params):
+    _import_crypto()
+    salt = salt + params.salt
+    if params.name == SCRYPT:
+        kdf = Scrypt(salt=salt, length=32, n=params.n, r=params.r, p=params.p, backend=default_backend())
+    else:
+        kdf = PBKDF2HMAC(algorithm=hashes.SHA256(), length=32, salt=salt, iterations=params.iterations, backend=default_backend())
+    return base64.urlsafe_b64encode(kdf.derive(pwd.encode())) # Can only use kdf once
+
+
+# A random key2 for a file without a read-only password
+def random_key():
+    _import_crypto()
+    return Fernet.generate_key()
+
+# Benchmark the key derivation on this machine and return the parameters that make one derivation take about
+# 'target' seconds. Opening a file costs one derivation; Save As costs two (run in parallel).
+def calibrate(name=PBKDF2, target=1.0):
+    def measure(params):
+        pwd = 'calibration'
+        salt = os.urandom(16)
+        return min(_timed(derive_key, pwd, salt, params) for i in range(3))
+    if name == SCRYPT:
+        # scrypt's cost is linear in n (a power of two) and so is its memory (128 * r * n bytes)
+        n = 2**12
+        t = measure(KDFParams(SCRYPT, n=n, r=8, p=1))
+        while n < 2**20 and t * 2 <= target: # Stop at 2^20 (1 GiB of memory)
+            n *= 2
+            t *= 2
+        return KDFParams(SCRYPT, n=max(n, 2**14), r=8, p=1)
+    iterations = 20000
+    t = measure(KDFParams(PBKDF2, iterations=iterations))
+    iterations = int(iterations * target / t) // 1000 * 1000 + 1
+    return KDFParams(PBKDF2, iterations=max(iterations, 20001))
+
+def _timed(func, *args):
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+
+# In-memory cache of derived keys
+# Deriving a key costs ~100,000 iterations of HMAC-SHA256 (or its scrypt equivalent), which is what makes brute force
+# expensive and what makes opening a file slow. Within a session we already paid that cost once for a given
+# (password, salt, parameters), so remember the result for a while.
+#  - Entries are keyed by an HMAC of the password with a per-process random secret, never by the password itself.
+#    A plain hash would be a fast-to-attack fingerprint of the password sitting in memory.
+#  - An entry expires after 'ttl' seconds without being used (idle timeout). ttl=0 disables caching.
+#  - At most 'maxsize' entries are kept; the least recently used one is evicted first.
+#  - flush() forgets everything (File > Lock).
+class KeyCache:
+    def __init__(self, ttl=300, maxsize=8):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._secret = os.urandom(32)
+        self._entries = OrderedDict() # (digest, salt, KDFParams) -> (key, time of last use)
+        self._lock = threading.Lock()
+
+    def _entry_id(self, pwd, salt, params):
+        digest = hmac.new(self._secret, pwd.encode(), hashlib.sha256).digest()
+        return (digest, bytes(salt), params)
+
+    def derive(self, pwd, salt, params):
+        key = self.get(pwd, salt, params)
+        if key is None:
+            # Derive outside of the lock so that a slow derivation does not block other lookups
+            key = derive_key(pwd, salt, params)
+            self.put(pwd, salt, params, key)
+        return key
+
+    # The cached key, or None without deriving it (e.g. to have it derived in another process and put back)
+    def get(self, pwd, salt, params):
+        if self.ttl <= 0 or self.maxsize <= 0:
+            return None
+        entry_id = self._entry_id(pwd, salt, params)
+        with self._lock:
+            self._expire(time.monotonic())
+            if entry_id in self._entries:
+                key = self._entries.pop(entry_id)[0]
+                self._entries[entry_id] = (key, time.monotonic()) # Move to the end (most recently used)
+                return key
+        return None
+
+    def put(self, pwd, salt, params, key):
+        if self.ttl <= 0 or self.maxsize <= 0:
+            return
+        entry_id = self._entry_id(pwd, salt, params)
+        with self._lock:
+            self._entries.pop(entry_id, None)
+            self._entries[entry_id] = (key, time.monotonic())
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False) # Evict the least recently used
+
+    def _expire(self, now):
+        # Entries are ordered by the time of last use, so stop at the first one that is still alive
+        while self._entries:
+            entry_id, (key, used) = next(iter(self._entries.items()))
+            if now - used < self.ttl:
+                break
+            del self._entries[entry_id]
+
+    # Drop idle entries; call this periodically so keys do not stay in memory long after they were last used
+    def expire(self):
+        with self._lock:
+            self._expire(time.monotonic())
+
+    def flush(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+
+# File format
+#
+# Version 0 (no header): '<text token>====<key token>'
+#  - text token = Fernet(key2).encrypt(text), key token = Fernet(key1).encrypt(key2)
+#  - key1 and key2 are derived with PBKDF2 from the program's salt only (see legacy_kdf())
+# Version 1: 'ENOTEPAD.1.<URL-safe Base64 of JSON>\n' followed by the version 0 body
+#  - JSON = {"kdf": {...}} (see kdf_to_dict())
+# Version 2: 'ENOTEPAD.2.<URL-safe Base64 of JSON>\n<text token>'
+#  - JSON = {"kdf": {...}, "slots": [{"role": "master", "key": "<key token>"}, {"role": "readonly"}]}
+#  - The key slots tell which passwords can open the file. The master slot holds key2 encrypted with key1, so the
+#    master password is checked with the header alone. The readonly slot is present if key2 is derived from a read-only
+#    password; if it is absent, key2 is random and an empty password need not be tried.
+# Version 3: 'ENOTEPAD.3.<URL-safe Base64 of JSON>\n' followed by one record per line in URL-safe Base64
+#  - JSON = version 2 + {"cipher": "aes-256-gcm", "chunk": <bytes>, "id": "<Base64 of 16 random bytes>"}
+#  - The UTF-8 text is cut into chunks of 'chunk' bytes, and each chunk is a record nonce (12 bytes) + AES-GCM
+#    ciphertext + tag (16 bytes) with associated data b'D'. The key is HKDF-SHA256(key2, salt=id).
+#  - The last record (associated data b'E') holds SHA-256 of the tags of all the chunk records in order followed by
+#    their number (8 bytes, big endian). A file that is truncated, reordered, or mixed with another one fails there.
+#  - So the file can be encrypted and decrypted one chunk at a time, and memory does not grow with the file size.
+#  - The text is cut at content-defined line boundaries (see _text_blocks()), so an edit changes only the chunks around
+#    it and Save copies the records of the other chunks as they are (see BlockMap).
+# Version 3 binary: MAGIC + b'\0' + version (1 byte) + length of JSON (4 bytes) + JSON, and then each record as its
+#   length (4 bytes) + record, all big endian. The same as above without the 33% overhead of Base64 and the pass to
+#   encode/decode it, for those who do not need to paste the file into an email.
+# Version 4: version 3 (either container) + {"compression": ["<codec>", <level>]} in JSON if the chunks are compressed
+#  - Each chunk is compressed on its own before encryption (so it can still be decrypted one chunk at a time) and
+#    prefixed with b'Z', or with b'R' and stored as is if it did not get smaller. See COMPRESSION.
+#
+# The first few bytes tell which one a file is, so a plain text file never goes through the encryption path and an
+# encrypted file is recognized without reading (let alone scanning) all of it.
+MAGIC = b'ENOTEPAD'
+TEXT = b'.'    # follows MAGIC in the text container
+BINARY = b'\0' # follows MAGIC in the binary container
+VERSION = 4
+CIPHER = 'aes-256-gcm'
+CHUNK_SIZE = 64 * 1024
+HEADER_SIZE = 64 * 1024 # Upper limit of the header line; it is a few hundred bytes in practice
+
+# Fernet tokens start with the version byte 0x80 followed by a 64-bit timestamp, which reads 'gAAAAA' in URL-safe Base64.
+# The key token at the end of a version 0 file always has 140 characters (a Fernet key is 44 bytes).
+FERNET_PREFIX = b'gAAAAA'
+LEGACY_TAIL = re.compile(rb'====[A-Za-z0-9_-]{140}')
+
+# Quick file checker of Base64 URL-safe decoding
+b64re = re.compile(r'^[A-Za-z0-9_=-]*$')
+
+# version: format version, kdf: KDFParams, master: key token in the master slot (None before version 2),
+# readonly: whether a read-only password may open the file (unknown before version 2, so assumed True),
+# id: random bytes that identify the file across saves, chunk: plaintext bytes per record (id and chunk from version 3),
+# binary: whether the file is in the binary container, compression: (codec, level) or None (from version 4)
+Header = namedtuple('Header', ['version', 'kdf', 'master', 'readonly', 'id', 'chunk', 'binary', 'compression'], defaults=[None, None, True, None, CHUNK_SIZE, False, None])
+
+# Header for a file that is encrypted for the first time (Save As, or Save of a file from an older version)
+def new_header(kdf, readonly, binary=False, compression=None):
+    return Header(VERSION, kdf, readonly=readonly, id=os.urandom(16), binary=binary, compression=compression)
+
+
+class DecryptionError(Exception):
+    pass
+
+
+def legacy_kdf(iterations):
+    return KDFParams(PBKDF2, b'', iterations=iterations)
+
+def format_header(header):
+    slots = [{'role': 'master', 'key': header.master.decode()}]
+    if header.readonly:
+        slots.append({'role': 'readonly'})
+    d = {'kdf': kdf_to_dict(header.kdf), 'slots': slots, 'cipher': CIPHER, 'chunk': header.chunk, 'id': base64.urlsafe_b64encode(header.id).decode()}
+    if header.compression is not None:
+        d['compression'] = list(header.compression)
+    d = json.dumps(d, separators=(',', ':')).encode()
+    if header.binary:
+        return MAGIC + BINARY + bytes([VERSION]) + len(d).to_bytes(4, 'big') + d
+    return b'%s%s%d.%s\n' % (MAGIC, TEXT, VERSION, base64.urlsafe_b64encode(d))
+
+# Parse the header line of the text container
+def parse_header(line):
+    try:
+        magic, version, header = line.rstrip(b'\r\n').split(b'.', 2)
+        return _parse_header(int(version), base64.urlsafe_b64decode(header))
+    except (ValueError, binascii.Error):
+        raise FormatError('Broken file header.')
+
+def _parse_header(version, header, binary=False):
+    if version > VERSION:
+        raise FormatError('The file was saved by a newer version of Encrypted Notepad.')
+    try:
+        header = json.loads(header)
+        kdf = kdf_from_dict(header['kdf'])
+        if version == 1:
+            return Header(1, kdf)
+        roles = {slot['role']: slot for slot in header['slots']}
+        if version == 2:
+            return Header(2, kdf, roles['master']['key'].encode(), 'readonly' in roles)
+        if header['cipher'] != CIPHER:
+            raise FormatError('Unsupported cipher: %s' % header['cipher'])
+        chunk = int(header['chunk'])
+        if not 0 < chunk <= 16 * 1024 * 1024:
+            raise FormatError('Broken file header.')
+        compression = header.get('compression') if version >= 4 else None
+        if compression is not None:
+            compression = check_compression(compression)
+        return Header(version, kdf, roles['master']['key'].encode(), 'readonly' in roles, base64.urlsafe_b64decode(header['id']), chunk, binary, compression)
+    except (ValueError, KeyError, TypeError, AttributeError, binascii.Error):
+        raise FormatError('Broken file header.')
+
+# Return the Header of the file, or None if it is not encrypted by this program
+# Only the header line (or the first and last few bytes of a version 0 file) is read.
+def sniff(fpath, iterations):
+    with open(fpath, 'rb') as file:
+        head = file.read(len(MAGIC) + 1)
+        if head == MAGIC + TEXT:
+            file.seek(0)
+            line = file.readline(HEADER_SIZE)
+            if not line.endswith(b'\n'):
+                raise FormatError('Broken file header.')
+            return parse_header(line)
+        if head == MAGIC + BINARY:
+            version = file.read(1)
+            length = int.from_bytes(file.read(4), 'big')
+            header = file.read(length) if length <= HEADER_SIZE else b''
+            if not version or len(header) != length or not header:
+                raise FormatError('Broken file header.')
+            return _parse_header(version[0], header, binary=True)
+        if head.startswith(FERNET_PREFIX):
+            # If the length of the text is not a multiple of 4, then not encoded
+            # If it does not end with the separator '====' and the key token, then not encrypted (by this program)
+            size = file.seek(0, os.SEEK_END)
+            if size % 4 == 0 and size > 144:
+                file.seek(-144, os.SEEK_END)
+                if LEGACY_TAIL.fullmatch(file.read()):
+                    return Header(0, legacy_kdf(iterations))
+    return None
+
+
+def read_text(fpath):
+    with open(fpath, 'r') as file:
+        return file.read()
+
+# The encrypted part of the file (without the header line)
+# A version 3 body is decrypted while it is read (see unlock()), so here it is only read through to bring it into the
+# OS cache while the key is being derived, and None is returned.
+def read_body(fpath, header):
+    if header.version >= 3:
+        with open(fpath, 'rb') as file:
+            while file.read(1024 * 1024):
+                pass
+        return None
+    with open(fpath, 'r') as file:
+        if header.version > 0:
+            file.readline()
+        return file.read()
+
+def write_text(fpath, text):
+    with open(fpath, 'w') as file:
+        file.write(text)
+
+# Write to a temporary file next to fpath and replace fpath only when everything is written, so that an error or
+# Cancel in the middle of a save does not leave a half-written file behind
+@contextmanager
+def atomic_write(fpath):
+    import tempfile, shutil # Only needed to save (see _import_crypto())
+    dirname, basename = os.path.split(os.path.abspath(fpath))
+    fd, tmppath = tempfile.mkstemp(dir=dirname, prefix='.' + basename + '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            yield file
+        if os.path.exists(fpath):
+            shutil.copymode(fpath, tmppath)
+        os.replace(tmppath, fpath)
+    except BaseException:
+        os.remove(tmppath)
+        raise
+
+
+# Return [encrypted text, encrypted key] if the body looks like version 0 (or 1), otherwise None
+def split_encrypted(text):
+    # If text can be decoded by URL-safe Base64 decoding, the file is likely to be encrypted => Ask password
+    # URL-safe Base64 encoding characters in regexp: '[a-zA-Z0-9_=-]'
+    # https://stackoverflow.com/questions/12315398/check-if-a-string-is-encoded-in-base64-using-python
+    # https://stackoverflow.com/questions/8571501/how-to-check-whether-a-string-is-base64-encoded-or-not/8571649#8571649
+    # base64.urlsafe_b64decode(text, validate=True) # validate option does not work for urlsafe version...
+
+    # If the length of the text is not a multiple of 4, then not encoded
+    if len(text) % 4 != 0:
+        return None
+
+    # If it does not contain one and only one separator '====', then not encoded (by this program)
+    # If the second part contains characters other than allowed in URL-safe Base64, then not encrypted
+    texts = text.rsplit('====')
+    if len(texts) != 2 or not b64re.fullmatch(texts[1]):
+        return None
+
+    # We can also check if texts[0] contains other characters, or the lengths of texts[0] and texts[1] are
+    # multiples of 4, etc. But I suspect there won't be practically relevant cases where these are helpful.
+    return texts
+
+
+def _stream_key(key2, header):
+    hkdf = HKDF(algorithm=hashes.SHA256(), length=32, salt=header.id, info=b'Encrypted Notepad text', backend=default_backend())
+    return hkdf.derive(base64.urlsafe_b64decode(key2))
+
+def _seal(aead, data, ad):
+    nonce = os.urandom(12)
+    return nonce + aead.encrypt(nonce, data, ad)
+
+def _open(aead, record, ad):
+    return aead.decrypt(record[:12], record[12:], ad)
+
+# Cut the text into blocks and yield them in UTF-8 of at most 'size' bytes
+# A block ends after a newline whose line ends with characters that hash to 0 mod 64 (so about every 64 lines), and is
+# between size/16 and size/4 characters long. Since the cut points depend only on the nearby text, an edit moves only
+# the boundaries of the blocks around it, and the other blocks come out the same as before.
+def _text_blocks(text, size):
+    low, high = size // 16, size // 4
+    pos = 0
+    while pos < len(text):
+        end = min(pos + high, len(text))
+        cut = end
+        i = text.find('\n', pos + low, end)
+        while i >= 0:
+            if zlib.crc32(text[max(i - 31, 0):i + 1].encode()) & 63 == 0:
+                cut = i + 1
+                break
+            i = text.find('\n', i + 1, end)
+        yield text[pos:cut].encode()
+        pos = cut
+
+
+# Where the record of each block of the text is in the file, so that Save copies the records of the unchanged blocks
+# instead of encrypting them again. Blocks are told apart by a keyed digest of their plaintext, and the map is valid only
+# for the file (path, id, container, compression, size and modification time) it was made from.
+class BlockMap:
+    def __init__(self):
+        self._key = os.urandom(32) # Per process, so the digests do not tell anything outside of it
+        self._source = None
+        self._records = {}
+
+    def digest(self, block):
+        return hashlib.blake2b(block, key=self._key, digest_size=16).digest()
+
+    def _fingerprint(self, fpath, header):
+        try:
+            st = os.stat(fpath)
+        except OSError:
+            return None
+        return (os.path.abspath(fpath), header.id, header.binary, header.compression, st.st_size, st.st_mtime_ns)
+
+    # Records of fpath that can be copied: {digest: [(offset, length, tag), ...]} (a copy the caller can consume)
+    def usable(self, fpath, header):
+        if self._source is None or self._source != self._fingerprint(fpath, header):
+            return {}
+        return {digest: list(spans) for digest, spans in self._records.items()}
+
+    def reset(self, fpath, header, records):
+        self._records = records
+        self._source = self._fingerprint(fpath, header)
+
+    def clear(self):
+        self._records = {}
+        self._source = None
+
+    def __len__(self):
+        return sum(len(spans) for spans in self._records.values())
+
+# Compression
+#
+# Text typically shrinks to a third or less, so fewer bytes go through the cipher and to the disk (or a cloud drive).
+# zstd is used only if the zstandard module is installed. levels: (lowest, default, highest)
+ZLIB = 'zlib'
+LZMA = 'lzma'
+ZSTD = 'zstd'
+COMPRESSION = {ZLIB: (1, 6, 9), LZMA: (0, 6, 9), ZSTD: (1, 3, 19)}
+
+def compressors():
+    names = [ZLIB, LZMA]
+    if importlib.util.find_spec('zstandard') is not None: # Without importing it
+        names.append(ZSTD)
+    return names
+
+# Validate (codec, level) from a file header or the settings and return it as a tuple
+def check_compression(compression):
+    codec, level = compression
+    if codec not in COMPRESSION or not isinstance(level, int):
+        raise FormatError('Unsupported compression: %s' % (compression,))
+    low, default, high = COMPRESSION[codec]
+    if not low <= level <= high:
+        raise FormatError('Unsupported compression: %s' % (compression,))
+    return (codec, level)
+
+# Return the functions that compress and decompress a chunk of at most limit bytes with (codec, level)
+def _codec(compression, limit):
+    codec, level = compression
+    if codec == ZLIB:
+        compress = lambda data: zlib.compress(data, level)
+        def decompress(data):
+            d = zlib.decompressobj()
+            data = d.decompress(data, limit + 1)
+            if not d.eof or d.unused_data:
+                raise zlib.error()
+            return data
+        return compress, decompress, zlib.error
+    if codec == LZMA:
+        compress = lambda data: lzma.compress(data, preset=level)
+        def decompress(data):
+            d = lzma.LZMADecompressor()
+            data = d.decompress(data, limit + 1)
+            if not d.eof or d.unused_data:
+                raise lzma.LZMAError()
+            return data
+        return compress, decompress, lzma.LZMAError
+    try:
+        import zstandard
+    except ImportError:
+        raise FormatError('zstd compression needs the zstandard module (pip install zstandard).')
+    c = zstandard.ZstdCompressor(level=level)
+    d = zstandard.ZstdDecompressor()
+    return c.compress, lambda data: d.decompress(data, max_output_size=limit + 1), zstandard.ZstdError
+
+# Return a function that compresses a chunk and prefixes it with b'Z' (or b'R' if it did not get smaller)
+# The function returns the chunk as is without compression.
+def _packer(compression, limit):
+    if compression is None:
+        return lambda chunk: chunk
+    compress = _codec(compression, limit)[0]
+    def pack(chunk):
+        packed = compress(chunk)
+        return b'Z' + packed if len(packed) < len(chunk) else b'R' + chunk
+    return pack
+
+def _decompress_chunks(chunks, compression, limit):
+    decompress, error = _codec(compression, limit)[1:]
+    for chunk in chunks:
+        if chunk[:1] == b'R':
+            data = chunk[1:]
+        elif chunk[:1] == b'Z':
+            try:
+                data = decompress(chunk[1:])
+            except error:
+                raise FormatError('The file is damaged.')
+        else:
+            raise FormatError('The file is damaged.')
+        if len(data) > limit:
+            raise FormatError('The file is damaged.')
+        yield data
+
+# Compress text with each setting (all the codecs at their lowest, default and highest levels if not given) and
+# encrypt it the way a file is saved, so the levels can be compared on real content.
+# Returns a list of (compression or None, bytes, seconds) with the uncompressed result first.
+def compression_report(text, settings=None, chunk=CHUNK_SIZE, cancel=None):
+    _import_crypto()
+    if settings is None:
+        settings = [(codec, level) for codec in compressors() for level in sorted(set(COMPRESSION[codec]))]
+    data = text.encode()
+    aead = AESGCM(AESGCM.generate_key(256))
+    report = []
+    for compression in [None] + list(settings):
+        start = time.perf_counter()
+        pack = _packer(compression, chunk)
+        size = 0
+        for i in range(0, len(data), chunk):
+            if cancel is not None and cancel.is_set():
+                raise Cancelled()
+            size += len(_seal(aead, pack(data[i:i + chunk]), b'D'))
+        report.append((compression, size, time.perf_counter() - start))
+    return report
+
+def _put_record(file, record, binary):
+    if binary:
+        file.write(len(record).to_bytes(4, 'big'))
+        file.write(record)
+    else:
+        file.write(base64.urlsafe_b64encode(record) + b'\n')
+
+# Yield (offset, length, record) of the records from the current position of the file
+def _get_records(file, header):
+    if not header.binary:
+        offset = file.tell()
+        for line in file:
+            try:
+                yield offset, len(line), base64.urlsafe_b64decode(line.rstrip(b'\r\n'))
+            except binascii.Error:
+                raise FormatError('The file is damaged.')
+            offset += len(line)
+        return
+    while True:
+        offset = file.tell()
+        length = file.read(4)
+        if not length:
+            return
+        length = int.from_bytes(length, 'big')
+        if length > header.chunk + 64: # Nonce and tag are 28 bytes, and the compression prefix 1 byte
+            raise FormatError('The file is damaged.')
+        record = file.read(length)
+        if len(record) != length:
+            raise FormatError('The file is truncated.')
+        yield offset, length + 4, record
+
+# Position the file right after the header
+def _skip_header(file, header):
+    if header.binary:
+        file.seek(len(MAGIC) + 2)
+        file.seek(int.from_bytes(file.read(4), 'big'), os.SEEK_CUR)
+    else:
+        file.readline()
+
+# Encrypt the chunks and write them as records, followed by the end record
+# With blocks (a BlockMap), a chunk whose record is in usable (see BlockMap.usable()) is copied from the file old instead
+# of being encrypted, and the records that are written are returned in the same form for the next save.
+# If added (a list) is given, the chunks that are encrypted, and the bytes around the boundary of every two chunks, are
+# appended to it for the search index (see write_index).
+def _write_records(file, chunks, key2, header, cancel=None, blocks=None, usable=None, old=None, added=None):
+    aead = AESGCM(_stream_key(key2, header))
+    pack = _packer(header.compression, header.chunk)
+    tags = hashlib.sha256()
+    count = 0
+    records = {}
+    tail = b''
+    for chunk in chunks:
+        if cancel is not None and cancel.is_set():
+            raise Cancelled()
+        offset = file.tell()
+        if blocks is not None:
+            digest = blocks.digest(chunk)
+            spans = usable.get(digest)
+            if spans:
+                start, length, tag = spans.pop()
+                old.seek(start)
+                file.write(old.read(length))
+            else:
+                record = _seal(aead, pack(chunk), b'D')
+                _put_record(file, record, header.binary)
+                tag = record[-16:]
+                if added is not None:
+                    added.append(chunk)
+            records.setdefault(digest, []).append((offset, file.tell() - offset, tag))
+        else:
+            record = _seal(aead, pack(chunk), b'D')
+            _put_record(file, record, header.binary)
+            tag = record[-16:]
+        if added is not None and tail:
+            added.append(tail + chunk[:8]) # At least the 2 characters on either side
+        tail = chunk[-8:]
+        tags.update(tag)
+        count += 1
+    _put_record(file, _seal(aead, tags.digest() + count.to_bytes(8, 'big'), b'E'), header.binary)
+    return records
+
+# Read the records from the current position of the file and yield the decrypted (and decompressed) chunks
+# Raises InvalidTag if the first record cannot be decrypted (wrong key) and FormatError if a later one fails.
+# (offset, length, tag) of each chunk record is appended to spans (if given) before the chunk is yielded.
+def _read_records(file, key2, header, cancel=None, spans=None):
+    chunks = _read_sealed(file, key2, header, cancel, spans)
+    if header.compression is not None:
+        chunks = _decompress_chunks(chunks, header.compression, header.chunk)
+    return chunks
+
+def _read_sealed(file, key2, header, cancel=None, spans=None):
+    aead = AESGCM(_stream_key(key2, header))
+    tags = hashlib.sha256()
+    count = 0
+    for offset, length, record in _get_records(file, header):
+        if cancel is not None and cancel.is_set():
+            raise Cancelled()
+        try:
+            chunk = _open(aead, record, b'D')
+        except InvalidTag:
+            try:
+                end = _open(aead, record, b'E')
+            except InvalidTag:
+                if count == 0:
+                    raise
+                raise FormatError('The file is damaged.')
+            if end != tags.digest() + count.to_bytes(8, 'big') or file.read(1):
+                raise FormatError('The file is damaged.')
+            return
+        tags.update(record[-16:])
+        count += 1
+        if spans is not None:
+            spans.append((offset, length, record[-16:]))
+        yield chunk
+    raise FormatError('The file is truncated.')
+
+# Decrypt a version 3 file with key2 and return the text in pieces (one per chunk, so no full-size copy is made)
+# If blocks (a BlockMap) is given, it is filled with the records of the file.
+# If stream is True, the pieces are returned as an iterator that decrypts the file as it goes; only the first record
+# is decrypted here (to tell whether key2 is right), and a damaged record later raises FormatError from the iterator.
+def _decrypt_pieces(fpath, key2, header, cancel=None, blocks=None, stream=False):
+    pieces = _iter_pieces(fpath, key2, header, cancel, blocks)
+    if not stream:
+        return list(pieces)
+    return itertools.chain([next(pieces)], pieces)
+
+def _iter_pieces(fpath, key2, header, cancel=None, blocks=None):
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    spans = []
+    records = {}
+    with open(fpath, 'rb') as file:
+        _skip_header(file, header)
+        for chunk in _read_records(file, key2, header, cancel, spans):
+            yield decoder.decode(chunk)
+            if blocks is not None:
+                records.setdefault(blocks.digest(chunk), []).append(spans[-1])
+    yield decoder.decode(b'', final=True)
+    if blocks is not None:
+        blocks.reset(fpath, header, records)
+
+
+# Read-only password implementation
+# Decrypt the file with the key derived from the password the user entered and return (pieces of text, key1, key2, read_only)
+#  - If the key decrypts the master slot, it is the master key (key1) and the slot holds the read-only key (key2)
+#  - If the key decrypts the text directly, it is the read-only key
+#  - If the password is empty and it fails, the file is opened as is
+# body is what read_body() returned, and blocks (a BlockMap, if given) is filled for write_encrypted()
+# If stream is True, the pieces of a version 3 file are decrypted as they are consumed (see _decrypt_pieces())
+def unlock(fpath, header, body, pwd, key, cancel=None, blocks=None, stream=False):
+    _import_crypto()
+    if header.version >= 3:
+        try:
+            key2 = Fernet(key).decrypt(header.master)
+        except InvalidToken:
+            key2 = None
+        if key2 is not None:
+            try:
+                return _decrypt_pieces(fpath, key2, header, cancel, blocks, stream), key, key2, False
+            except InvalidTag:
+                raise FormatError('The file is damaged.')
+        try:
+            if not header.readonly:
+                raise InvalidTag()
+            return _decrypt_pieces(fpath, key, header, cancel, stream=stream), None, key, True
+        except InvalidTag:
+            if pwd == '' and not header.binary: # If Read-Only with no password fails, open without decryption
+                return [read_text(fpath)], None, None, False
+            raise DecryptionError()
+    if header.master is None:
+        texts = split_encrypted(body)
+        if texts is None: # Not encrypted after all => Open the file as is
+            return [body], None, None, False
+        token, master = texts[0].encode(), texts[1].encode()
+    else:
+        token, master = body.strip().encode(), header.master
+    if pwd == '': # OK with no input => Try Read-Only, otherwise Open file without decryption
+        try:
+            if not header.readonly:
+                raise InvalidToken()
+            return [Fernet(key).decrypt(token).decode()], None, key, True
+        except InvalidToken: # If Read-Only with no password fails, open without decryption (the whole file, header too)
+            return [read_text(fpath)], None, None, False
+    try:
+        key2 = Fernet(key).decrypt(master)
+        return [Fernet(key2).decrypt(token).decode()], key, key2, False
+    except InvalidToken:
+        try:
+            if not header.readonly:
+                raise InvalidToken()
+            return [Fernet(key).decrypt(token).decode()], None, key, True
+        except InvalidToken:
+            raise DecryptionError()
+
+
+# Encrypt text with key2 and key2 with key1, and write them to fpath in the current version
+# header gives the key derivation (of key1 and key2), whether key2 is derived from a read-only password, and the id.
+# The header can be reused, but we want the header to rather change every time (Fernet is a probabilistic encryption)
+# If blocks (a BlockMap filled by unlock() or the last save of fpath) is given, the records of the unchanged blocks are
+# copied from the current file, so the cost of a save (and what changes for a sync client) follows the size of the edit.
+# With index, the search index of the text is written next to the file (see write_index), updated from the index of the
+# current file with the blocks that are not copied if there is one; otherwise an index left from an earlier save, which
+# would no longer match the file, is removed.
+def write_encrypted(fpath, text, key1, key2, header, cancel=None, blocks=None, index=False):
+    _import_crypto()
+    old_index = _read_index(fpath, key2, header) if index and blocks is not None and header.master is not None else None
+    header = header._replace(version=VERSION, master=Fernet(key1).encrypt(key2))
+    if header.id is None: # From an older version
+        header = header._replace(id=os.urandom(16))
+    usable = blocks.usable(fpath, header) if blocks is not None else {}
+    added = [] if old_index is not None and usable else None
+    with atomic_write(fpath) as file:
+        file.write(format_header(header))
+        # The current file is closed before it is replaced (Windows does not allow replacing an open file)
+        with open(fpath, 'rb') if usable else contextlib.nullcontext() as old:
+            records = _write_records(file, _text_blocks(text, header.chunk), key2, header, cancel, blocks, usable, old, added)
+    if blocks is not None:
+        blocks.reset(fpath, header, records)
+    if index:
+        write_index(fpath, text, key2, header, old_index if added is not None else None, added)
+    else:
+        remove_index(fpath)
+    return header
+
+
+# Edit journal
+#
+# '<file>.journal' keeps the edits made since the file was last saved, so they survive a crash without the whole file
+# being written for every edit. It is MAGIC + b'J' + base (16 bytes) followed by records of length (4 bytes, big
+# endian) + nonce (12 bytes) + AES-GCM ciphertext + tag.
+#  - base is a digest of the master slot of the file, which changes on every save, so a journal is replayed only on the
+#    very file it was written against (and is ignored after the file is saved or replaced).
+#  - A record holds a zlib-compressed JSON list of edits (see the Notepad's _on_text_command()). The key is
+#    HKDF-SHA256(key2, salt=id) with its own info, and the associated data is b'J' + base + sequence number (8 bytes),
+#    so records cannot be reordered or dropped. A record cut off by a crash ends the journal.
+JOURNAL_SUFFIX = '.journal'
+
+def journal_path(fpath):
+    return fpath + JOURNAL_SUFFIX
+
+def _journal_key(key2, header):
+    hkdf = HKDF(algorithm=hashes.SHA256(), length=32, salt=header.id, info=b'Encrypted Notepad journal', backend=default_backend())
+    return hkdf.derive(base64.urlsafe_b64decode(key2))
+
+def _journal_base(header):
+    return hashlib.sha256(header.master).digest()[:16]
+
+def _journal_ad(base, seq):
+    return b'J' + base + seq.to_bytes(8, 'big')
+
+# Return (edits, records, end) of the journal of fpath, where edits is the list of all the edits in the journal and end
+# is the offset after the last valid record, or None if there is no journal for this version of the file
+def read_journal(fpath, key2, header):
+    _import_crypto()
+    try:
+        file = open(journal_path(fpath), 'rb')
+    except FileNotFoundError:
+        return None
+    with file:
+        base = _journal_base(header)
+        if file.read(len(MAGIC) + 1 + len(base)) != MAGIC + b'J' + base:
+            return None
+        aead = AESGCM(_journal_key(key2, header))
+        edits = []
+        seq = 0
+        end = file.tell()
+        while True:
+            length = int.from_bytes(file.read(4), 'big')
+            record = file.read(length)
+            if length == 0 or len(record) != length:
+                break
+            try:
+                edits.extend(json.loads(zlib.decompress(_open(aead, record, _journal_ad(base, seq)))))
+            except (InvalidTag, zlib.error, ValueError):
+                break
+            seq += 1
+            end = file.tell()
+    return edits, seq, end
+
+def remove_journal(fpath):
+    try:
+        os.remove(journal_path(fpath))
+    except FileNotFoundError:
+        pass
+
+# Appends records to the journal of fpath in a thread of its own, so that writing (and fsync) never holds up typing
+# If resume is the return value of read_journal(), the records are appended to that journal; otherwise a new one is
+# started. The caller decides how often to call append() (each call is one record).
+class Journal:
+    def __init__(self, fpath, key2, header, resume=None):
+        _import_crypto()
+        self.fpath = fpath
+        self._aead = AESGCM(_journal_key(key2, header))
+        self._base = _journal_base(header)
+        self._queue = queue.Queue()
+        if resume is not None:
+            self._seq, end = resume[1], resume[2]
+            self._file = open(journal_path(fpath), 'r+b')
+            self._file.truncate(end) # Drop a record cut off by a crash
+            self._file.seek(end)
+        else:
+            self._seq = 0
+            self._file = open(journal_path(fpath), 'wb')
+            self._write(MAGIC + b'J' + self._base)
+        self.size = self._file.tell()
+        self.error = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _write(self, data):
+        self._file.write(data)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def _run(self):
+        while True:
+            edits = self._queue.get()
+            if edits is None:
+                return
+            try:
+                record = _seal(self._aead, zlib.compress(json.dumps(edits, separators=(',', ':')).encode()), _journal_ad(self._base, self._seq))
+                self._write(len(record).to_bytes(4, 'big') + record)
+                self._seq += 1
+                self.size += 4 + len(record)
+            except OSError as e:
+                self.error = e # The journal stops here; it is only a safety net, so the editor goes on
+
+    def append(self, edits):
+        if self.error is None:
+            self._queue.put(list(edits))
+
+    # Write what is queued and close the journal; delete it if the edits in it are no longer needed
+    def close(self, delete=False):
+        self._queue.put(None)
+        self._thread.join()
+        self._file.close()
+        if delete:
+            remove_journal(self.fpath)
+
+
+# Search index
+#
+# '<file>.index' lets Search in Files tell, without decrypting the file, that the file cannot contain a pattern. It is
+# MAGIC + b'I' + base (as in the journal) + one record: nonce (12 bytes) + AES-GCM ciphertext + tag of the zlib-compressed
+# bitmap of INDEX_BITS bits, in which the bits of the hashes of all the trigrams (3 characters) of the case-folded text
+# are set, followed by the number of bytes added to it since it was built from the whole text (8 bytes, big endian).
+# So a trigram whose bit is not set is not in the text; one whose bit is set may be. The key is
+# HKDF-SHA256(key2, salt=id) with its own info, and the associated data is b'I' + base, so an index is used only with
+# the very save of the file it was written with.
+INDEX_SUFFIX = '.index'
+INDEX_BITS = 1 << 18
+
+def index_path(fpath):
+    return fpath + INDEX_SUFFIX
+
+def _index_key(key2, header):
+    hkdf = HKDF(algorithm=hashes.SHA256(), length=32, salt=header.id, info=b'Encrypted Notepad index', backend=default_backend())
+    return hkdf.derive(base64.urlsafe_b64decode(key2))
+
+def _trigram_bit(trigram):
+    return zlib.crc32(trigram.encode()) & (INDEX_BITS - 1)
+
+# The index is built from the whole text, or, with old (the contents of the index of the file before the save, see
+# _read_index) and added (the pieces of UTF-8 text the save did not copy, see _write_records), it is old with the
+# trigrams of added, so that a save that copies most blocks does not go through the whole text either. The trigrams of
+# deleted text stay in it then, which only makes the index rule out fewer files, until the bytes added since it was last
+# built from the whole text are more than the text, and it is built from the whole text again.
+def write_index(fpath, text, key2, header, old=None, added=None):
+    _import_crypto()
+    stale = int.from_bytes(old[INDEX_BITS // 8:], 'big') + sum(len(piece) for piece in added) if old is not None else 0
+    if old is None or stale > len(text):
+        bitmap = bytearray(INDEX_BITS // 8)
+        pieces = [text]
+        stale = 0
+    else:
+        bitmap = bytearray(old[:INDEX_BITS // 8])
+        pieces = (piece.decode(errors='ignore') for piece in added) # Cut characters at the ends are left out
+    for piece in pieces:
+        piece = piece.casefold()
+        for trigram in set(zip(piece, piece[1:], piece[2:])):
+            bit = _trigram_bit(''.join(trigram))
+            bitmap[bit >> 3] |= 1 << (bit & 7)
+    base = _journal_base(header)
+    with atomic_write(index_path(fpath)) as file:
+        file.write(MAGIC + b'I' + base + _seal(AESGCM(_index_key(key2, header)), zlib.compress(bytes(bitmap) + stale.to_bytes(8, 'big')), b'I' + base))
+
+# Return the contents of the index of fpath, or None if there is none for this save of the file (or it is damaged)
+def _read_index(fpath, key2, header):
+    _import_crypto()
+    base = _journal_base(header)
+    try:
+        with open(index_path(fpath), 'rb') as file:
+            data = file.read(len(MAGIC) + 1 + len(base) + 12 + INDEX_BITS // 8 + 1024) # More than any index
+    except OSError:
+        return None
+    if not data.startswith(MAGIC + b'I' + base):
+        return None
+    try:
+        contents = zlib.decompressobj().decompress(_open(AESGCM(_index_key(key2, header)), data[len(MAGIC) + 1 + len(base):], b'I' + base), INDEX_BITS // 8 + 8)
+    except (InvalidTag, zlib.error, ValueError):
+        return None
+    return contents if len(contents) == INDEX_BITS // 8 + 8 else None
+
+# Return the bitmap of the index of fpath, or None (see _read_index)
+def read_index(fpath, key2, header):
+    contents = _read_index(fpath, key2, header)
+    return contents[:INDEX_BITS // 8] if contents is not None else None
+
+def remove_index(fpath):
+    try:
+        os.remove(index_path(fpath))
+    except FileNotFoundError:
+        pass
+
+# The trigrams (case-folded) that every text with a match of the pattern contains, as far as can be told from the
+# pattern: all those of a plain pattern, and those of the runs of plain characters that a regular expression cannot
+# match without. Groups, alternatives, inline flags, escapes of letters and so on are not looked into, which only means
+# fewer trigrams (or none).
+def pattern_trigrams(pattern, regexp):
+    runs = [pattern]
+    if regexp:
+        if '|' in pattern or '(?' in pattern: # Alternatives, or flags like (?x) that change what the characters mean
+            return set()
+        runs = ['']
+        depth = 0 # of parentheses
+        i = 0
+        while i < len(pattern):
+            c = pattern[i]
+            i += 1
+            if c == '\\':
+                if i == len(pattern) or pattern[i].isalnum(): # \w, \b, \1, \x41, \u0041 etc., which may stand for letters
+                    return set()
+                c = pattern[i] # An escaped character
+                i += 1
+                if depth > 0:
+                    continue
+            elif c in '()':
+                depth += 1 if c == '(' else -1
+                runs.append('')
+                continue
+            elif depth > 0:
+                continue
+            elif c == '[': # Skip the set
+                if pattern[i:i+1] == '^':
+                    i += 1
+                if pattern[i:i+1] == ']':
+                    i += 1
+                while i < len(pattern) and pattern[i] != ']':
+                    if pattern[i] == '[': # [:alpha:] and the like
+                        return set()
+                    i += 2 if pattern[i] == '\\' else 1
+                i += 1
+                runs.append('')
+                continue
+            elif c in '*?{': # The character before is optional
+                runs[-1] = runs[-1][:-1]
+                if c == '{':
+                    while i < len(pattern) and pattern[i] != '}':
+                        i += 1
+                    i += 1
+                runs.append('')
+                continue
+            elif c in '.^$+':
+                runs.append('')
+                continue
+            runs[-1] += c
+    trigrams = set()
+    for run in runs:
+        run = run.casefold()
+        trigrams.update(run[i:i+3] for i in range(len(run) - 2))
+    return trigrams
+
+# Whether a text with the index bitmap may contain all the trigrams
+def index_may_contain(bitmap, trigrams):
+    for trigram in trigrams:
+        bit = _trigram_bit(trigram)
+        if not bitmap[bit >> 3] & (1 << (bit & 7)):
+            return False
+    return True
+
+
+# Search
+# Yield (line number, line) of the lines in the pieces of text that the compiled pattern (of re or regex) matches
+# With timeout (for a pattern of the regex module), TimeoutError is raised once the searches have taken that many
+# seconds in all (not counting the time to decrypt the pieces).
+def grep_pieces(pattern, pieces, timeout=None):
+    left = timeout
+    def search(line):
+        nonlocal left
+        if timeout is None:
+            return pattern.search(line)
+        start = time.monotonic()
+        try:
+            return pattern.search(line, timeout=max(left, 0.001))
+        finally:
+            left -= time.monotonic() - start
+    number = 0
+    rest = ''
+    for piece in pieces:
+        lines = (rest + piece).split('\n')
+        rest = lines.pop()
+        for line in lines:
+            number += 1
+            if search(line):
+                yield number, line
+    if rest and search(rest):
+        yield number + 1, rest
+
+# Search a file for Search in Files; run in a worker process, so everything comes in and goes out by value.
+# key is the key of pwd for the file if it is already known, otherwise it is derived here. If the file has a search
+# index (see write_index) that lacks any of the trigrams (see pattern_trigrams), the file itself is not decrypted.
+# Returns (the first limit of the lines grep_pieces yields, the key of pwd or None for a file that is not encrypted,
+# whether the index ruled the file out). Raises DecryptionError if pwd does not open the file, FormatError/OSError/
+# UnicodeDecodeError as opening it does, and TimeoutError if the search takes more than timeout (see grep_pieces).
+def search_file(fpath, pattern, pwd, key, salt, iterations, trigrams=(), limit=1000, timeout=None):
+    header = sniff(fpath, iterations)
+    if header is None:
+        return list(itertools.islice(grep_pieces(pattern, [read_text(fpath)], timeout), limit)), None, False
+    if key is None:
+        key = derive_key(pwd, salt, header.kdf)
+    if trigrams and header.version >= 4:
+        _import_crypto()
+        try:
+            key2 = Fernet(key).decrypt(header.master)
+        except InvalidToken:
+            key2 = key if header.readonly else None # The read-only password gives key2 itself
+        bitmap = read_index(fpath, key2, header) if key2 is not None else None
+        if bitmap is not None and not index_may_contain(bitmap, trigrams):
+            return [], key, True
+    pieces, key1, key2, read_only = unlock(fpath, header, read_body(fpath, header), pwd, key, stream=True)
+    if key2 is None: # An empty password that fails opens the file as is
+        raise DecryptionError()
+    return list(itertools.islice(grep_pieces(pattern, pieces, timeout), limit)), key, False